@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import itertools
+import subprocess
+import numpy as np
+from SSconfig import SSConfig as CFG
+CFG.LOG['info'] = False
+from SSdatabase import SSDatabase
+from SSscheduler import SSScheduler
+from SSsimulator import SimulationClock
+
+'''
+SSbench times the scheduling hot path on a cluster of fake daemons (as SSSimulator.addFakeDeamons),
+with a controlled fill level (the fraction of cores used by running jobs) and queue depth (pending jobs).
+Entry points, each timed per call with a fresh state where it matters:
+  nextJob: SSScheduler.nextJob in a steady state, the oldest running job finishes after each call
+  search: SSCluster.search for the demand of the most prior job, not served by the unsatisfied cache
+  mostPriorJob: SSDatabase.mostPriorJob, the clock advances by a second each call
+  allocateFor: SSDatabase.allocateFor for the demand of the most prior job, the allocation is cancelled
+The programs are those in the profile store (run it where progs_profile.txt is), bw/hc/lu/cg/mg/ep without it.
+The results are a json list of points, a point per (entry, algorithm, nodes, fill, queue).
+'''
+ENTRIES = ['nextJob', 'search', 'mostPriorJob', 'allocateFor']
+PROGS = ['bw-28', 'hc-28', 'lu-16', 'cg-16', 'mg-16', 'ep-16']
+
+class SSBench:
+    def __init__(self, alg, nodes, fill, queue, seed=0):
+        self.rng = random.Random(seed)
+        self.clock = SimulationClock()
+        self.db = SSDatabase(algorithm=alg, simulationClock=self.clock, logToFile=False, profileStore=CFG.DB['sim_profile_store'])
+        self.sched = SSScheduler(algoname=alg, database=self.db)
+        for i in range(nodes):
+            self.db.addDaemon('sn' + str(i), 'sn' + str(i))
+        self.progs = sorted(self.db.progToProfile.keys()) or PROGS
+        # a job spans about 1/200 of the cluster, so filling takes a few hundred jobs at any size
+        self.nodesPerJob = max(1, nodes // 200)
+        self.totalCores = nodes * CFG.CLUSTER['core_per_node']
+        self.fill(fill)
+        self.queue = queue
+        self.refill()
+        # jobs started by the timed nextJob calls
+        self.started = 0
+
+    def addJob(self):
+        prog = self.rng.choice(self.progs)
+        # a job of several nodes uses whole nodes, as in the converted traces
+        n = self.rng.randint(1, self.nodesPerJob)
+        if n > 1:
+            nproc = n * CFG.CLUSTER['core_per_node']
+        else:
+            nproc = int(prog.split('-')[-1]) if '-' in prog else CFG.CLUSTER['core_per_node']
+        return self.db.addUserJob({'jobname': prog, 'framework': 'MPI', 'parallelism': nproc, 'alpha': 0.9})
+
+    def usedCores(self):
+        return self.totalCores - sum([node['capacity'][0] for node in self.db.cluster.nodes.values()])
+
+    # start jobs until fill of the cores is used, or jobs keep not fitting
+    # a job that does not fit stays pending, in the queue
+    def fill(self, fill):
+        misses = 0
+        while self.usedCores() < fill * self.totalCores and misses < 100:
+            jobid = self.addJob()
+            allocation, est = self.sched.tryAllocate(jobid)
+            if allocation:
+                self.db.jobStart(jobid, est)
+                misses = 0
+            else:
+                misses += 1
+            self.clock.tick()
+
+    # keep queue pending jobs, a quarter of them have been stuck (a slower priority stride)
+    def refill(self):
+        while len(self.db.pendingJobs) < self.queue:
+            jobid = self.addJob()
+            if self.rng.random() < 0.25:
+                self.db.jobStuck(jobid)
+
+    def finishOldest(self):
+        jobid = self.db.runningJobs[0]
+        for daemon in list(self.db.jobidToDaemons[jobid]):
+            self.db.daemonFinishJob(daemon, jobid, {'exitcode': 0})
+
+    # the first demand of the most prior job, (jobid, (N, C, W, B, scale, mode, toprofile)) or None
+    def headDemand(self):
+        jobid = self.db.mostPriorJob()
+        if jobid is None:
+            return None
+        demands = self.sched.demandsOf(self.db.getProfile(jobid))
+        return (jobid, demands[0]) if len(demands) else None
+
+    # seconds of each call
+    def time(self, entry, calls):
+        times = []
+        for _ in range(calls):
+            if entry == 'nextJob':
+                self.refill()
+                st = time.perf_counter()
+                allocation, _ = self.sched.nextJob()
+                times.append(time.perf_counter() - st)
+                if allocation:
+                    self.started += 1
+                # a job finishes after each call, so a stuck head is retried with a changed cluster
+                if len(self.db.runningJobs):
+                    self.finishOldest()
+                self.clock.tick()
+            elif entry == 'mostPriorJob':
+                st = time.perf_counter()
+                self.db.mostPriorJob()
+                times.append(time.perf_counter() - st)
+                self.clock.tick()
+            else:
+                head = self.headDemand()
+                if head is None:
+                    break
+                jobid, (N, C, W, B, scale, mode, toprofile) = head
+                if entry == 'search':
+                    self.db.cluster.unsatisfied = (-1, set())
+                    st = time.perf_counter()
+                    self.db.cluster.search(N, {'C':C, 'W':W, 'B':B})
+                    times.append(time.perf_counter() - st)
+                else:
+                    self.db.cluster.unsatisfied = (-1, set())
+                    st = time.perf_counter()
+                    allocation = self.db.allocateFor(jobid, N, C, W, B, scale, mode, toprofile)
+                    times.append(time.perf_counter() - st)
+                    if allocation:
+                        self.db.allocationCancel(jobid)
+        return times
+
+    def close(self):
+        self.db.close()
+
+def summary(times):
+    us = np.array(times) * 1e6
+    if len(us) == 0:
+        return {'calls': 0}
+    return {'calls': len(us), 'min_us': float(us.min()), 'median_us': float(np.median(us)),
+            'mean_us': float(us.mean()), 'p90_us': float(np.percentile(us, 90)), 'max_us': float(us.max())}
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def parseArgs():
+    ap = argparse.ArgumentParser(description='Time the scheduler entry points at different cluster sizes.')
+    ap.add_argument('--algs', nargs='+', default=['CE', 'CS', 'SS'])
+    ap.add_argument('--nodes', nargs='+', type=int, default=[10, 100, 1000, 5000, 20000])
+    ap.add_argument('--fills', nargs='+', type=float, default=[0.5, 0.9], help='fractions of cores used by running jobs')
+    ap.add_argument('--queues', nargs='+', type=int, default=[10, 1000], help='pending jobs')
+    ap.add_argument('--entries', nargs='+', default=ENTRIES, choices=ENTRIES)
+    ap.add_argument('--calls', type=int, default=200, help='timed calls of each entry point')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--out', default=None, help='write the json results to this file, stdout if not given')
+    return ap.parse_args()
+
+if __name__ == '__main__':
+    args = parseArgs()
+    results = []
+    print('%12s\t%4s\t%6s\t%5s\t%6s\t%6s\t%10s\t%10s' % ('ENTRY', 'ALGO', 'NODES', 'FILL', 'QUEUE', 'CALLS', 'MEDIAN_US', 'P90_US'), file=sys.stderr)
+    for alg, nodes, fill, queue in itertools.product(args.algs, args.nodes, args.fills, args.queues):
+        for entry in args.entries:
+            # each entry point on its own state, the steady state of nextJob changes the cluster
+            bench = SSBench(alg, nodes, fill, queue, seed=args.seed)
+            point = {'entry': entry, 'alg': alg, 'nodes': nodes, 'fill': fill, 'queue': queue,
+                     'actual_fill': bench.usedCores() / bench.totalCores}
+            point.update(summary(bench.time(entry, args.calls)))
+            if entry == 'nextJob':
+                point['started'] = bench.started
+                point['end_fill'] = bench.usedCores() / bench.totalCores
+            bench.close()
+            results.append(point)
+            print('%12s\t%4s\t%6d\t%5.2f\t%6d\t%6d\t%10.1f\t%10.1f' % (entry, alg, nodes, fill, queue, point['calls'],
+                point.get('median_us', 0), point.get('p90_us', 0)), file=sys.stderr, flush=True)
+    report = {
+        'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                 'commit': gitCommit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'calls': args.calls, 'seed': args.seed},
+        'results': results,
+    }
+    if args.out:
+        with open(args.out, 'w') as fw:
+            json.dump(report, fw, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
@@ -0,0 +1,317 @@
+#!/usr/bin/python3
+import os
+import sys
+import abc
+import json
+import socket
+import socketserver
+import subprocess
+import threading
+from SSlogger import SSLogger
+from SSconfig import SSConfig as CFG
+
+'''
+SSCat programs the CAT (cache allocation technology) of the local node.
+A layout is a dict, COS id -> (way bitmask, tuple of cores), an empty layout means reset.
+The layout last applied is kept, and only the COS entries that differ from it are programmed.
+Cores that are no longer in any COS go back to COS 0, and a COS that is no longer in the layout is removed.
+A job keeps its COS id while it runs (see cosIds), so the other jobs starting or finishing only changes its COS
+if its ways or cores change.
+Each apply bumps the version, applyIf only applies if the version is still the one given, so the
+sampler (see SSmonitor.set_cat) does not undo the layout a runner applied after it.
+Backends (CFG.CAT['backend']):
+  pqos: pqos over ssh to root@hostname, the original way
+  resctrl: write the resctrl filesystem directly, needs root
+  helper: send the changes to a privileged SScat.py helper over a persistent unix socket
+  fake: only record what would be programmed, for tests and dry runs
+'''
+class SSCat(abc.ABC):
+    def __init__(self, hostname=None):
+        self.hostname = hostname if hostname else socket.gethostname()
+        self.logger = SSLogger('CAT', info=False)
+        # the layout programmed now, None if unknown
+        self.current = None
+        # runners of co-located jobs apply layouts concurrently
+        self.lock = threading.Lock()
+        # bumped by each apply
+        self.version = 0
+        # jobid -> COS id, of the jobs in the last layout asked for
+        self.jobCos = dict()
+
+    # return the version of this layout
+    def apply(self, layout):
+        with self.lock:
+            return self.applyLocked(layout)
+
+    # apply unless another layout has been applied since version, return the new version or None
+    def applyIf(self, layout, version):
+        with self.lock:
+            if self.version != version:
+                return None
+            return self.applyLocked(layout)
+
+    def applyLocked(self, layout):
+        self.version += 1
+        if layout == self.current:
+            return self.version
+        if len(layout) == 0:
+            self.reset()
+            self.current = dict()
+            return self.version
+        cur = self.current if self.current is not None else dict()
+        masks = dict()
+        cores = dict()
+        for cos, (mask, corelist) in layout.items():
+            if self.current is None or cos not in cur or cur[cos][0] != mask:
+                masks[cos] = mask
+            if self.current is None or cos not in cur or cur[cos][1] != corelist:
+                cores[cos] = corelist
+        # cores released by all COS
+        used = set(c for _, corelist in layout.values() for c in corelist)
+        released = sorted(set(c for _, corelist in cur.values() for c in corelist) - used)
+        if len(released):
+            cores[0] = tuple(released)
+        self.program(masks, cores)
+        dropped = sorted(set(cur) - set(layout))
+        if len(dropped):
+            self.remove(dropped)
+        self.current = layout
+        return self.version
+
+    # jobid -> COS id for the jobs on the node now, the jobs already there keep their ids
+    # and a new job takes the smallest id not used
+    def cosIds(self, jobids):
+        with self.lock:
+            self.jobCos = dict([(jobid, cos) for jobid, cos in self.jobCos.items() if jobid in jobids])
+            used = set(self.jobCos.values())
+            cos = 1
+            for jobid in sorted(jobids):
+                if jobid not in self.jobCos:
+                    while cos in used:
+                        cos += 1
+                    self.jobCos[jobid] = cos
+                    used.add(cos)
+            return dict(self.jobCos)
+
+    # the layout may have been changed by someone else (e.g. SSmonitor), program it all next time
+    def invalidate(self):
+        with self.lock:
+            self.current = None
+
+    # masks: COS id -> way bitmask to set; cores: COS id -> cores to assign to it
+    @abc.abstractmethod
+    def program(self, masks, cores):
+        pass
+
+    @abc.abstractmethod
+    def reset(self):
+        pass
+
+    # the COS ids no longer in the layout, their cores are already back in COS 0
+    # a COS cannot be removed by default, it keeps its mask until it is used again
+    def remove(self, coses):
+        pass
+
+class SSPqosCat(SSCat):
+    def run(self, pqosCmd):
+        subprocess.run(['ssh', 'root@' + self.hostname, pqosCmd], stdout=subprocess.DEVNULL)
+
+    def program(self, masks, cores):
+        if len(masks):
+            self.run('pqos -e "%s"' % ';'.join(['llc:%d=%s' % (cos, hex(mask)) for cos, mask in masks.items()]))
+        if len(cores):
+            self.run('pqos -a "%s"' % ';'.join(['llc:%d=%s' % (cos, ','.join(map(str, corelist))) for cos, corelist in cores.items()]))
+
+    def reset(self):
+        self.run('pqos -R')
+
+class SSResctrlCat(SSCat):
+    def __init__(self, hostname=None):
+        super().__init__(hostname)
+        self.root = CFG.CAT['resctrl_path']
+        # L3 cache ids, the same mask is set for all of them as 'pqos -e' does
+        self.domains = None
+
+    def cacheDomains(self):
+        if self.domains is None:
+            self.domains = []
+            with open(os.path.join(self.root, 'schemata')) as fr:
+                for line in fr:
+                    line = line.strip()
+                    if line.startswith('L3:'):
+                        self.domains = [d.split('=')[0] for d in line[3:].split(';')]
+        return self.domains
+
+    # the resctrl group of a COS, COS 0 is the default group
+    def group(self, cos):
+        if cos == 0:
+            return self.root
+        path = os.path.join(self.root, 'COS%d' % cos)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        return path
+
+    def write(self, path, value):
+        with open(path, 'w') as fw:
+            fw.write(value + '\n')
+
+    def program(self, masks, cores):
+        for cos, mask in masks.items():
+            schemata = 'L3:' + ';'.join(['%s=%x' % (d, mask) for d in self.cacheDomains()])
+            self.write(os.path.join(self.group(cos), 'schemata'), schemata)
+        for cos, corelist in cores.items():
+            self.write(os.path.join(self.group(cos), 'cpus_list'), ','.join(map(str, corelist)))
+
+    # removing a group returns its cores to the default group
+    def remove(self, coses):
+        for cos in coses:
+            path = os.path.join(self.root, 'COS%d' % cos)
+            if cos != 0 and os.path.isdir(path):
+                os.rmdir(path)
+
+    def reset(self):
+        for name in os.listdir(self.root):
+            if name.startswith('COS') and os.path.isdir(os.path.join(self.root, name)):
+                os.rmdir(os.path.join(self.root, name))
+
+class SSHelperCat(SSCat):
+    def __init__(self, hostname=None):
+        super().__init__(hostname)
+        self.path = CFG.CAT['helper_socket']
+        self.sock = None
+        self.reader = None
+
+    def disconnect(self):
+        if self.reader:
+            self.reader.close()
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.reader = None
+
+    # send a request (a line of json), connect again once if the helper has gone, raise unless it is programmed
+    # called with the lock held (by apply)
+    def request(self, req):
+        msg = (json.dumps(req) + '\n').encode('utf-8')
+        for retry in range(2):
+            try:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self.sock.connect(self.path)
+                    self.reader = self.sock.makefile('rb')
+                self.sock.sendall(msg)
+                reply = self.reader.readline().decode('utf-8').strip()
+                if len(reply) == 0: # the helper closed the connection
+                    raise ConnectionResetError('CAT helper closed the connection')
+                break
+            except OSError as e:
+                self.logger.warn('CAT helper:', e)
+                self.disconnect()
+                if retry:
+                    raise
+        # the layout is not recorded as applied unless the helper has programmed it
+        if reply != 'ok':
+            raise RuntimeError('CAT helper failed: %s' % reply)
+
+    def program(self, masks, cores):
+        self.request({'masks': [[cos, mask] for cos, mask in masks.items()],
+                      'cores': [[cos, list(corelist)] for cos, corelist in cores.items()]})
+
+    def remove(self, coses):
+        self.request({'remove': list(coses)})
+
+    def reset(self):
+        self.request({'reset': True})
+
+class SSFakeCat(SSCat):
+    def __init__(self, hostname=None):
+        super().__init__(hostname)
+        # what would have been programmed, in order
+        self.calls = []
+
+    def program(self, masks, cores):
+        self.calls.append(('program', masks, cores))
+        self.logger.info('program masks', masks, 'cores', cores)
+
+    def remove(self, coses):
+        self.calls.append(('remove', coses))
+        self.logger.info('remove', coses)
+
+    def reset(self):
+        self.calls.append(('reset',))
+        self.logger.info('reset')
+
+BACKENDS = {
+    'pqos': SSPqosCat,
+    'resctrl': SSResctrlCat,
+    'helper': SSHelperCat,
+    'fake': SSFakeCat,
+}
+
+# one backend for the whole process, shared by the runners
+theBackend = None
+def getCatBackend():
+    global theBackend
+    if theBackend is None:
+        theBackend = BACKENDS[CFG.CAT['backend']]()
+    return theBackend
+
+# cores[i] = jobid, jobid uses this i-th core
+# ways[i] = jobid, jobid uses this i-th way
+# the spare ways are given to the jobs, and the ways of each job are made contiguous
+# cosIds maps the jobids to their COS ids (e.g. SSCat.cosIds), by default they are numbered in jobid order
+def catLayout(cores, ways, cosIds=None):
+    jobids = set(ways) # what jobs are explicitly using LLC
+    if -1 in jobids:
+        jobids.remove(-1) # -1 means no job
+    if len(jobids) == 0: # no CAT, reset. For LLC-unaware policies like CE and CS
+        return dict()
+    jobids = sorted(jobids)
+    cosOf = cosIds(jobids) if cosIds else dict([(jobid, i+1) for i, jobid in enumerate(jobids)])
+    ways = [jid if jid != -1 else jobids[i % len(jobids)] for i, jid in enumerate(ways)]
+    ways.sort()
+    layout = dict()
+    for jobid in jobids:
+        mask = 0
+        for w, jid in enumerate(ways):
+            if jid == jobid:
+                mask |= 1 << w
+        layout[cosOf[jobid]] = (mask, tuple([c for c, jid in enumerate(cores) if jid == jobid]))
+    return layout
+
+# the privileged helper, a line of json request in (see SSHelperCat), a line of 'ok' or the error out
+# the changes are programmed as they come, the client keeps the layout
+class SSCatHelperHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+                with self.server.lock:
+                    if req.get('reset', False):
+                        self.server.backend.reset()
+                    elif 'remove' in req:
+                        self.server.backend.remove(req['remove'])
+                    else:
+                        self.server.backend.program(dict(req['masks']), dict([(cos, tuple(corelist)) for cos, corelist in req['cores']]))
+                self.wfile.write(b'ok\n')
+            except Exception as e:
+                self.wfile.write(('%s\n' % repr(e)).encode('utf-8'))
+
+def serveHelper():
+    path = CFG.CAT['helper_socket']
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socketserver.ThreadingUnixStreamServer(path, SSCatHelperHandler)
+    server.daemon_threads = True
+    server.backend = BACKENDS[CFG.CAT['helper_backend']]()
+    # several daemons may share a node
+    server.lock = threading.Lock()
+    # the daemons connect as their own user, the group of the socket decides who may use it
+    os.chmod(path, 0o660)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'helper':
+        serveHelper()
+    else:
+        print('Usage: ./SScat.py helper')
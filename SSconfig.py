@@ -15,6 +15,13 @@ class SSConfig:
     # Network setting
     NET = {
         'eoc': chr(200),
+        # length-prefixed framing, a frame is the magic byte, 4-byte big-endian length, and the json
+        # the magic byte never appears in utf-8, so it cannot be the start of an eoc-terminated object
+        'frame_magic': 0xff,
+        'framing': 'length', # the framing to use if the peer supports it, length or eoc
+        'recv_bufsize': 1<<18,
+        # a destination with more bytes than this waiting to be sent is reported congested
+        'outbox_high_water': 1<<24,
         'broken_conn_str': 'Broken Connection',
         'new_conn_str': 'New Connection',
         'master_hostname': 'bic05',
@@ -30,14 +37,52 @@ class SSConfig:
     }
     # Database setting
     DB = {
-        'profile_fname': 'progs_profile.txt',
+        'profile_fname': 'progs_profile.txt', # imported into the store whenever it changes
+        'profile_store': 'progs_profile.db',
+        'sim_profile_store': ':memory:', # of simulations, a copy of profile_store, see SSProfileStore
         'history_prefix': 'job_history',
+        'history_gzip': False, # compress the history file
+        'history_flush_records': 256, # records written at a time
+        'history_flush_seconds': 5, # the longest a record waits to be written
         'default_stride': 100,
         'slow_stride': 50,
+        # the runtimes after profiling, see SSDatabase.updateRunStats
+        'ewma_alpha': 0.2,
+        'refine_min_runs': 3, # runs before the observed runtime replaces the estimation
+        'refine_sigma': 1.0, # standard deviations added to the observed runtime
+        'reprofile_error': 0.3, # relative estimation error to profile again (SS only)
+    }
+    # Scheduler setting
+    SCHED = {
+        'backfill_modes': ['none', 'easy'],
+        'backfill_depth': 64, # how many pending jobs are tried for backfilling
+    }
+    # CAT programming, see SScat.py
+    CAT = {
+        'backend': 'pqos', # pqos, resctrl, helper or fake
+        'resctrl_path': '/sys/fs/resctrl',
+        'helper_socket': '/run/sscat.sock',
+        'helper_backend': 'resctrl', # what the helper uses to program CAT
     }
     # Profiling setting
     PROF = {
         'sample_ways': [20, 8, 4, 2],
+        # the counter source of SSSampler, perf or synthetic
+        'sampler': 'perf',
+        # perf needs root, the command is run through this prefix (%s is the hostname), empty to run locally
+        'perf_prefix': 'ssh root@%s',
+        # instructions, cycles, then the memory read/write events (64 bytes each), for Intel Xeon E5-2680 v4
+        'perf_events': ['instructions', 'cycles',
+                        'uncore_ha_0/event=0x01,umask=0x03/', 'uncore_ha_1/event=0x01,umask=0x03/',
+                        'uncore_ha_0/event=0x01,umask=0x0C/', 'uncore_ha_1/event=0x01,umask=0x0C/'],
+        'interval_ms': 1000,
+        'sample_intervals': 5, # intervals in a sample
+        # fixed: cycle over sample_ways for the whole job
+        # adaptive: stop once the confidence intervals (relative half width ci_rel) converge,
+        #   adding points where the curve is off the line of its neighbors by more than bend_rel
+        'schedule': 'fixed',
+        'adaptive': {'min_samples': 3, 'max_samples': 10, 'ci_rel': 0.05, 'bend_rel': 0.05, 'max_points': 8},
+        'synthetic': {'ipc': 1.5, 'membw': 40, 'sensitivity': 1.0, 'knee': 4, 'noise': 0.02, 'seed': 0, 'interval_s': 1.0},
     }
     # Running jobs
     RUN = {
@@ -1,9 +1,12 @@
 #!/usr/bin/python3
 import time
+import queue
 from SSnetwork import SSWorkerNetwork
 from SSprotocol import SSProtocol
 from SSlogger import SSLogger
 from SSjobrunner import SSJobRunner
+from SSmonitor import SSSampler
+from SSconfig import SSConfig as CFG
 
 class SSDaemon:
     def __init__(self):
@@ -12,29 +15,44 @@ class SSDaemon:
         self.logger = SSLogger('Daemon')
         #self.msgLock = threading.Lock() 
         self.jobrunners = []
+        # started with the first job to profile, then kept for the life of the daemon
+        self.sampler = None
+        # runners put themselves here when their jobs finish, and wake up the daemon
+        self.finished = queue.SimpleQueue()
+        self.net.addWakeup()
         #self.profiler = None
         time.sleep(1) # if not wait, will fail to connect, reason unknown
-        self.net.sendObj(self.prtl.greeting('daemon', self.net.hostname)) # I am a daemon
+        self.net.sendObj(self.prtl.greeting('daemon', self.net.hostname, CFG.NET['framing'])) # I am a daemon
         #self.net.sendObj(self.prtl.machineinfo({'hostname': self.net.hostname, 'core': 28, 'llcway': 20, 'membw': 120}))
     
+    # called by the runner thread when its job finishes
+    def jobFinished(self, runner):
+        self.finished.put(runner)
+        self.net.wakeup()
+
     def run(self):
-        # try to get new message
-        master, msg = self.net.recvObj()
+        # wait for a new message or a finished job
+        master, msg = self.net.recvObj(timeout=None)
         if master:
             if msg == self.net.CONNECTION_BROKEN:
                 exit()
             # acts accordingly
-            if self.prtl.isnewjob(msg):
-                runner = SSJobRunner(self.net.hostname, msg['jobspec'], name='Jobrunner@'+self.net.hostname)
+            if self.prtl.isgreeting(msg): # master agrees on the framing
+                self.net.setFraming('master', self.prtl.framingof(msg))
+            elif self.prtl.isnewjob(msg):
+                runner = SSJobRunner(self.net.hostname, msg['jobspec'], name='Jobrunner@'+self.net.hostname, 
+                                     onFinish=self.jobFinished, sampler=self.sampler)
+                # only the node that profiles the job needs the counters
+                if runner.needProfile(msg['jobspec']) and self.sampler is None:
+                    self.sampler = SSSampler()
+                    self.sampler.start()
+                    runner.sampler = self.sampler
                 runner.start()
                 self.jobrunners.append(runner)
-        # try to check job completion
-        done_runners = []
-        for jr in self.jobrunners:
-            if not jr.is_alive(): # job finish
-                self.net.sendObj(self.prtl.jobfinish(jr.jobspec['jobid'], jr.returns)) 
-                done_runners.append(jr)
-        for jr in done_runners:
+        # report finished jobs right away
+        while not self.finished.empty():
+            jr = self.finished.get()
+            self.net.sendObj(self.prtl.jobfinish(jr.jobspec['jobid'], jr.returns)) 
             self.jobrunners.remove(jr)
     
 if __name__ == '__main__':
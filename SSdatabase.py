@@ -1,19 +1,36 @@
 import json
 import os
+import atexit
+import heapq
+import math
+import itertools
+from bisect import bisect_left, bisect_right, insort
+from functools import lru_cache
 from datetime import datetime
 from SSlogger import SSLogger
 from SSconfig import SSConfig as CFG
+from SSprofile import stackReturns, aggregate, toLists, SSProfileStore
+from SShistory import SSHistoryWriter, compactRecord
 '''
 Database of jobs profile and history, statistics and so on
 '''
 class SSDatabase:
-    def __init__(self, algorithm, simulationClock=None, logToFile=True):
+    def __init__(self, algorithm, simulationClock=None, logToFile=True, profileStore=None):
         # the file use to store history, in json format
         self.logToFile = logToFile
         if self.logToFile:
             self.historyFilename = 'JobLogs/%s_%s_%s_%s.txt' % (CFG.DB['history_prefix'], 'sim' if simulationClock else 'run', algorithm, datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
-        # the file use to store profile, in json format
+            if CFG.DB['history_gzip']:
+                self.historyFilename += '.gz'
+            # records are written in the background, in batches, see SSHistoryWriter
+            self.historyWriter = SSHistoryWriter(self.historyFilename)
+            atexit.register(self.close)
+        # re-profiling is only triggered in real runs, a simulated runtime comes from the profile itself
+        self.algorithm = algorithm
+        # the text file of profiles, in json format, imported into the profile store (see SSProfileStore)
         self.profileFilename = CFG.DB['profile_fname']
+        # the path of the profile store, ':memory:' for a copy in memory that runs do not change (see loadProfile)
+        self.profileStorePath = profileStore if profileStore else CFG.DB['profile_store']
         # a simulated clock for simulation
         self.simulationClock = simulationClock
 
@@ -28,6 +45,8 @@ class SSDatabase:
         #   'framework': 'MPI' use to build running command
         #   'parallelism': 16 how many cores needed
         #   'alpha': a factor indicates tolerable performance loss
+        #   'walltime': optional, the runtime given by the user, scaled by the speed ratio of the allocation
+        #               (the duration of a job in a simulated trace)
         self.jobidToJobattr = dict()
         # record the resource a job using
         self.jobidToResource = dict()
@@ -35,16 +54,27 @@ class SSDatabase:
         self.jobidToDaemons = dict()
         # record the returns of a job
         self.jobidToReturns = dict()
-        # a priority criteria used for scheduling
-        # jobid -> (current priority, stride, last check timestamp)
+        # a priority criteria used for scheduling, only for pending jobs
+        # the priority grows linearly with time, by stride per second, and a job with smaller jobid wins a tie
+        # so the order is kept by value(t) - jobid = intercept + stride * t
+        # jobid -> {'intercept', 'stride', 'since': submit timestamp, 'entry': its entry in the heap}
         self.jobidToPriority = dict()
+        # stride -> a heap of (-intercept, jobid), jobs with the same stride keep their order over time
+        # entries of started jobs or changed strides are left in the heaps and skipped when popped
+        self.priorityHeaps = dict()
+        # the last time priorities are checked, a new stride takes effect from here
+        self.priorityCheck = None
         # profile data for programs
         # a program is the executable binary of a job, TODO, more accurate signature
         # currently, we use the jobname 'MG16' as the program signature
         # self.progToProfile['MG16'] is a dict
         # profile[scale factor] = {'time': exectution time, 'ipcs': ipc-ways curve, 'mbws': membw-ways curve}
         self.progToProfile = dict()
-        self.loadProfileFromFile()
+        self.profileStore = None
+        self.loadProfile()
+        # running statistics of the runs after profiling, (prog, scale, W) -> 
+        #   {'n': runs, 'mean': EWMA of runtime, 'var': EW variance of runtime, 'err': EWMA of relative estimation error}
+        self.runStats = dict()
         # three lists: pending, running, finished
         self.pendingJobs = []
         self.runningJobs = []
@@ -53,26 +83,22 @@ class SSDatabase:
         # use jobid as key
         self.history = dict()
 
-    def loadProfileFromFile(self):
-        # if no such file, create one
-        if not os.path.exists(self.profileFilename):
-            with open(self.profileFilename, 'w+') as fw:
-                fw.write('') 
-        # in the file, each line is a dict
-        # {'prog': prog, 'scale': scale, 'value': value} 
+    def loadProfile(self):
+        # the store imports the text file if it has changed
+        # a store in memory starts from the store of the real runs
+        copyFrom = CFG.DB['profile_store'] if self.profileStorePath == ':memory:' else None
+        self.profileStore = SSProfileStore(self.profileStorePath, self.profileFilename, copyFrom)
         # self.progToProfile[prog][scale] = value
-        cnt = 0
-        with open(self.profileFilename, 'r') as fr:
-            for line in fr.readlines():
-                if len(line.strip()) == 0:
-                    continue
-                kv = json.loads(line)
-                cnt += 1
-                prog, scale, value = kv['prog'], kv['scale'], kv['value']
-                if prog not in self.progToProfile:
-                    self.progToProfile[prog] = dict()
-                self.progToProfile[prog][scale] = value
-        self.logger.info('Profile Loaded, %d Entries in total.' % cnt)
+        self.progToProfile = self.profileStore.load()
+        self.logger.info('Profile Loaded, %d Entries in total.' % self.profileStore.count())
+
+    # write all buffered history, and close the profile store
+    def close(self):
+        if self.logToFile:
+            self.historyWriter.close()
+        if self.profileStore:
+            self.profileStore.close()
+            self.profileStore = None
 
     def getTimestampNow(self):
         if self.simulationClock:
@@ -90,26 +116,39 @@ class SSDatabase:
         self.jobidToJobattr[jobid] = job
         # add to the pending list
         self.pendingJobs.append(jobid)
-        self.jobidToPriority[jobid] = {'value':0, 'stride':CFG.DB['default_stride'], 'lastcheck':self.getTimestampNow()}
+        # the priority value starts from 0 at submission
+        now = self.getTimestampNow()
+        self.jobidToPriority[jobid] = {'intercept': -jobid, 'stride': 0, 'since': now, 'entry': None}
+        self.setPriorityStride(jobid, CFG.DB['default_stride'])
         # record the submit time
         self.history[self.jobid] = {'submitTime': self.getTimestampNow(), 'jobattr': job}
         self.jobid += 1
         return jobid
     
-    def jobStart(self, jobid, est=-1):
+    # backfill: whether the job is started by backfilling
+    def jobStart(self, jobid, est=-1, backfill=False):
         self.cluster.resourceAlloc(self.jobidToResource[jobid], jobid)
         self.jobidToDaemons[jobid] = [x for x,_,_ in self.jobidToResource[jobid]]
         self.jobidToReturns[jobid] = []
         #self.logger.debug(self.jobidToDaemons)
         self.pendingJobs.remove(jobid)
         self.runningJobs.append(jobid)
+        # no longer pending, evict it from the priority table
+        self.jobidToPriority.pop(jobid)
         # recover all priority stride
-        for _, p in self.jobidToPriority.items():
-            p['stride'] = CFG.DB['default_stride']
+        for stride in list(self.priorityHeaps.keys()):
+            if stride == CFG.DB['default_stride']:
+                continue
+            for _, jid in self.priorityHeaps.pop(stride):
+                p = self.jobidToPriority.get(jid, None)
+                if p and p['stride'] == stride:
+                    self.setPriorityStride(jid, CFG.DB['default_stride'])
         self.history[jobid]['startTime'] = self.getTimestampNow()
         self.history[jobid]['estTime'] = est
+        self.history[jobid]['backfill'] = backfill
         self.logger.info('job [%d] (%s) starts, scale %d, resource req:' % (jobid, self.jobidToJobattr[jobid]['jobname'], self.history[jobid]['scale']), 
-            self.history[jobid]['NCWB'], ', on nodes:', self.history[jobid]['nodelist'], 'NewProfiling' if self.history[jobid]['toprofile'] else 'InDB')
+            self.history[jobid]['NCWB'], ', on nodes:', self.history[jobid]['nodelist'], 'NewProfiling' if self.history[jobid]['toprofile'] else 'InDB',
+            'Backfilled' if backfill else '')
     
     def jobFinish(self, jobid):
         # record the end time
@@ -134,8 +173,7 @@ class SSDatabase:
                 (jobid, self.jobidToJobattr[jobid]['jobname'], jobtime, est, exitcode))
         # log the execution record
         if self.logToFile:
-            with open(self.historyFilename, 'a') as fw:
-                fw.write('JOBID %5d: %s\n' % (jobid, json.dumps(self.history[jobid])))
+            self.historyWriter.write(jobid, compactRecord(jobid, self.history[jobid], lambda d: self.cluster.nodes[d]['hostname']))
         # update the profile
         if self.history[jobid]['toprofile']:
             scale = self.history[jobid]['scale']
@@ -146,35 +184,79 @@ class SSDatabase:
             # may be repeated by several concurrent profiling runs, only the first one is used
             # ?? or use the last one ??
             if scale not in self.progToProfile[prog]:
-                wcnt = CFG.CLUSTER['llcway_per_node'] + 1
-                ipcs = [0]*wcnt
-                mbws = [0]*wcnt
-                ret_cnt = [0]*wcnt
-                # average of all daemons
-                for ret in returns:
-                    if 'ipcs' not in ret:
-                        continue
-                    for w in range(1, wcnt):
-                        ipc, mbw = ret['ipcs'][w], ret['mbws'][w]
-                        if ipc > 0 and mbw > 0:
-                            ipcs[w] += ipc
-                            mbws[w] += mbw
-                            ret_cnt[w] += 1
-                for w in range(1, wcnt):
-                    ipcs[w] = int(10000*ipcs[w]/ret_cnt[w])/10000 if ret_cnt[w] > 0 else -1
-                    mbws[w] = int(10000*mbws[w]/ret_cnt[w])/10000 if ret_cnt[w] > 0 else -1
+                # average of all daemons, -1 for the ways no daemon knows, 0 for no way
+                ipcs, mbws = toLists(aggregate(stackReturns(returns)))
+                ipcs[0], mbws[0] = 0, 0
                 self.progToProfile[prog][scale] = { 'time': jobtime, 'ipcs': ipcs, 'mbws': mbws }
-                # log to file
-                with open(self.profileFilename, 'a') as fw:
-                    fw.write(json.dumps({'prog': prog, 'scale': scale, 'value': self.progToProfile[prog][scale]}))
-                    fw.write('\n')
+                # save to the store
+                self.profileStore.add(prog, scale, self.progToProfile[prog][scale])
                 self.logger.debug('profile:', self.progToProfile[prog][scale])
+        elif exitcode == 0:
+            self.updateRunStats(jobid, jobtime)
         # update other data structures        
         self.cluster.resourceFree(self.jobidToResource[jobid])
         self.jobidToDaemons.pop(jobid)
         self.completedJobs.append(jobid)
         self.runningJobs.remove(jobid)
     
+    def runStatsKey(self, jobid):
+        return (self.jobidToJobattr[jobid]['jobname'], self.history[jobid]['scale'], self.history[jobid]['NCWB'][2])
+
+    # fold the runtime of a finished job into the statistics, the error is against the estimation it started with
+    # re-profile the (prog, scale) if the estimation is off by more than CFG.DB['reprofile_error'] on average
+    def updateRunStats(self, jobid, jobtime):
+        key = self.runStatsKey(jobid)
+        if key not in self.runStats:
+            self.runStats[key] = {'n': 0, 'mean': jobtime, 'var': 0, 'err': 0}
+        st = self.runStats[key]
+        alpha = CFG.DB['ewma_alpha']
+        diff = jobtime - st['mean']
+        st['mean'] += alpha * diff
+        st['var'] = (1 - alpha) * (st['var'] + alpha * diff * diff)
+        st['n'] += 1
+        est = self.history[jobid]['estTime']
+        if est and est != -1 and est[0] > 0:
+            st['err'] += alpha * ((jobtime - est[0]) / est[0] - st['err'])
+        if self.simulationClock or self.algorithm != 'SS' or st['n'] < CFG.DB['refine_min_runs']:
+            return
+        if abs(st['err']) > CFG.DB['reprofile_error']:
+            prog, scale, _ = key
+            self.logger.warn('%s at scale %d is %.0f%% off the estimation, to profile again' % (prog, scale, 100*st['err']))
+            # the other scales are relative to scale 1 (see SSSSAlgorithm), without it the whole profile goes
+            if scale == 1:
+                self.progToProfile.pop(prog, None)
+                self.profileStore.remove(prog)
+            else:
+                if prog in self.progToProfile:
+                    self.progToProfile[prog].pop(scale, None)
+                self.profileStore.remove(prog, scale)
+            for k in [k for k in self.runStats if k[0] == prog and (scale == 1 or k[1] == scale)]:
+                self.runStats.pop(k)
+
+    # the estimation (est_time, est_ratio) of a job, the walltime of the job if it has one replaces the
+    # est_time from the profile, as a user walltime does
+    def userEstimate(self, jobid, est):
+        walltime = self.jobidToJobattr[jobid].get('walltime', 0)
+        if not est or est == -1 or walltime <= 0:
+            return est
+        return (walltime * est[1], est[1])
+
+    # the estimated runtime of a job with its current allocation, None if no estimation
+    # the runtime observed for the same (prog, scale, W) replaces the estimation from the profile,
+    # padded by CFG.DB['refine_sigma'] standard deviations so that a backfilled job rarely delays the head
+    # only backfilling (reservations and estimatedFinish) uses it, the estimations of the algorithms
+    # (e.g. the scale SS picks) and the packing still come from the profiles
+    def refinedEstimate(self, jobid, est):
+        # a walltime is already what the job takes
+        if self.jobidToJobattr[jobid].get('walltime', 0) > 0:
+            return est[0] if est and est != -1 else None
+        st = self.runStats.get(self.runStatsKey(jobid), None)
+        if st and st['n'] >= CFG.DB['refine_min_runs']:
+            return st['mean'] + CFG.DB['refine_sigma'] * math.sqrt(st['var'])
+        if not est or est == -1:
+            return None
+        return est[0]
+
     # should receive a message from each daemon, then the job is really completed.
     def daemonFinishJob(self, dae, jobid, jobreturns):
         self.jobidToDaemons[jobid].remove(dae)
@@ -184,33 +266,127 @@ class SSDatabase:
     
     def jobStuck(self, jobid):
         # decrease its priority stride
-        self.jobidToPriority[jobid]['stride'] = CFG.DB['slow_stride']
-    
+        self.setPriorityStride(jobid, CFG.DB['slow_stride'])
+
+    # change the stride of a pending job, from the last check (or its submission if later)
+    def setPriorityStride(self, jobid, stride):
+        p = self.jobidToPriority[jobid]
+        if p['stride'] == stride:
+            return
+        ts = p['since'] if self.priorityCheck is None else max(self.priorityCheck, p['since'])
+        p['intercept'] += (p['stride'] - stride) * ts
+        p['stride'] = stride
+        p['entry'] = (-p['intercept'], jobid)
+        if stride not in self.priorityHeaps:
+            self.priorityHeaps[stride] = []
+        heapq.heappush(self.priorityHeaps[stride], p['entry'])
+
+    # the top job of each heap, a list of (intercept, stride, jobid)
+    def priorityTops(self):
+        tops = []
+        for stride in list(self.priorityHeaps.keys()):
+            heap = self.priorityHeaps[stride]
+            while len(heap) and self.jobidToPriority.get(heap[0][1], {}).get('entry', None) is not heap[0]:
+                heapq.heappop(heap)
+            if len(heap) == 0:
+                self.priorityHeaps.pop(stride)
+                continue
+            tops.append((-heap[0][0], stride, heap[0][1]))
+        return tops
+
+    # the highest priority (value - jobid) wins, (intercept, stride, jobid) or None
+    # on an exact tie of value - jobid the smaller jobid wins, the old stable sort of pendingJobs kept
+    # the order of the previous call instead, so a tie may now go to another job than it did
+    def priorityHead(self, tops, now):
+        head, headKey = None, None
+        for intercept, stride, jobid in tops:
+            key = intercept + stride * now
+            if head is None or key > headKey or (key == headKey and jobid < head[2]):
+                head, headKey = (intercept, stride, jobid), key
+        return head
+
     def mostPriorJob(self):
-        # update the priority for all jobs
         now = self.getTimestampNow()
-        for _, p in self.jobidToPriority.items():
-            p['value'] += p['stride'] * (now - p['lastcheck'])
-            p['lastcheck'] = now
-        # sort pending jobs by their priority (highest first)
-        self.pendingJobs.sort(key=lambda x: self.jobidToPriority[x]['value']-x, reverse=True)
-        return self.pendingJobs[0]
+        self.priorityCheck = now
+        head = self.priorityHead(self.priorityTops(), now)
+        return head[2] if head else None
+
+    # the earliest time another job may catch up with the most prior job, None if never
+    # only a job with a larger stride can catch up
+    def nextPriorityChange(self):
+        now = self.getTimestampNow()
+        tops = self.priorityTops()
+        head = self.priorityHead(tops, now)
+        ans = None
+        if head:
+            for intercept, stride, _ in tops:
+                if stride > head[1]:
+                    ts = (head[0] - intercept) / (stride - head[1])
+                    if ans is None or ts < ans:
+                        ans = ts
+        return ans
     
+    # at most cnt pending jobs with the highest priority, most prior first
+    def priorJobs(self, cnt):
+        now = self.getTimestampNow()
+        ps = self.jobidToPriority
+        return heapq.nlargest(cnt, ps.keys(), key=lambda x: (ps[x]['intercept'] + ps[x]['stride'] * now, -x))
+
+    # the estimated finish time of a running job, None if no estimation
+    def estimatedFinish(self, jobid):
+        est = self.refinedEstimate(jobid, self.history[jobid]['estTime'])
+        if est is None:
+            return None
+        return self.history[jobid]['startTime'] + est
+
+    # reserve resource for a job that cannot be allocated now
+    # running jobs are assumed to finish at their estimated time, those without estimation never finish
+    # return (shadow time, extra nodes, projected node capacity), or None if it will not fit,
+    # shadow time is the earliest time that N nodes satisfy perNodeReq, extra nodes is how many more than N
+    # projected[daemon] is the capacity key at shadow time of nodes that have changed
+    def reserve(self, N, perNodeReq):
+        cnt = self.cluster.countSatisfying(perNodeReq)
+        if cnt >= N:
+            return (self.getTimestampNow(), cnt - N, dict())
+        ends = []
+        for jobid in self.runningJobs:
+            et = self.estimatedFinish(jobid)
+            if et is not None:
+                ends.append((et, jobid))
+        ends.sort()
+        projected = dict()
+        for et, jobid in ends:
+            for daemon, nodeAlloc, _ in self.jobidToResource[jobid]:
+                before = projected.get(daemon, self.cluster.nodes[daemon]['capacity'])
+                after = self.cluster.capacityAfter(before, nodeAlloc, 1)
+                projected[daemon] = after
+                if not self.cluster.capacitySatisfy(before, perNodeReq) and self.cluster.capacitySatisfy(after, perNodeReq):
+                    cnt += 1
+            if cnt >= N:
+                return (et, cnt - N, projected)
+        return None
+
     # return all current profile of the program corresponding to jobid
     def getProfile(self, jobid):
         attr = self.jobidToJobattr[jobid]
         prog = attr['jobname']
         return (attr['parallelism'], attr['alpha'], self.progToProfile.get(prog, None))
 
-    # find allocation (None if not found)
-    # scale and mode are for record in history, the NCWB values already imply them
-    def allocateFor(self, jobid, N, C, W, B, scale, mode, toprofile):
+    # whether a job is allowed to use N nodes with the scale
+    def allocatable(self, jobid, N, scale):
         # some jobs cannot be scaling out
         if self.jobidToJobattr[jobid]['framework'] == 'TensorFlow': # now we use only single node tf programs
             if scale != 1:
-                return None
+                return False
         # do not allow spread for big jobs. (half machine)
         if N > 32 and scale > 1 and N/scale > 0.5 * len(self.cluster.nodes):
+            return False
+        return True
+
+    # find allocation (None if not found)
+    # scale and mode are for record in history, the NCWB values already imply them
+    def allocateFor(self, jobid, N, C, W, B, scale, mode, toprofile):
+        if not self.allocatable(jobid, N, scale):
             return None
         # try to allocate resource 
         perNodeReq = {'C':C, 'W':W, 'B':B}
@@ -248,6 +424,38 @@ class SSDatabase:
             #self.logger.warn('Cannot allocate resource for', jobid)
             return None
 
+    # drop an allocation found by allocateFor, if the job is not going to start with it
+    def allocationCancel(self, jobid):
+        self.jobidToResource.pop(jobid)
+        for k in ['allocation', 'nodelist', 'NCWB', 'scale', 'mode', 'toprofile']:
+            self.history[jobid].pop(k)
+
+
+# bitmask helpers, nodes share a few distinct masks, so the results are cached
+# number of set bits in a bitmask
+@lru_cache(maxsize=1<<16)
+def popcount(mask):
+    return bin(mask).count('1')
+
+# a bitmask of the lowest n set bits in mask
+@lru_cache(maxsize=1<<16)
+def lowestBits(mask, n):
+    ans = 0
+    for _ in range(n):
+        low = mask & -mask
+        ans |= low
+        mask ^= low
+    return ans
+
+# ids of the set bits in mask, lowest first
+@lru_cache(maxsize=1<<16)
+def bitsOf(mask):
+    ids = []
+    while mask:
+        low = mask & -mask
+        ids.append(low.bit_length() - 1)
+        mask ^= low
+    return tuple(ids)
 
 '''
 Cluster is a collection of nodes
@@ -257,14 +465,29 @@ node is a dict, keys: hostname, core, llcways, membw, mpi, ml, spark
 node[hostname] is a string of hostname
 node[core] is a list of core availability, -1 is availablit, other is the jobid on it
 node[llcway] is a list of llcways assignment, -1 is not specify, other is the jobid on it
+node[freecore] is a bitmask of available cores, bit i is set if node[core][i] is -1
+node[freeway] is a bitmask of unassigned llcways, bit i is set if node[llcway][i] is -1
 node[membw] is a float, how much memory bandwidth is left
 node[mpi,tf,spark] are virtual resources, notes whether the node is able to run this type of jobs
 if > 0, yes; if = 0, currenlty no; if < 0, forever no.
+Nodes are also indexed by their free capacity, so that search does not scan all nodes
+capacity[(free cores, free llcways, membw left)] is a sorted list of node indices,
+node index is the order a node is added, daemonOfIndex[index] is its daemon
+node[capacity] is the key of the node in the capacity index
 '''
 class SSCluster:
     def __init__(self):
         self.nodes = dict()
         self.jobToResource = dict()
+        # capacity index, see above
+        self.capacity = dict()
+        self.capacityPenalties = dict()
+        self.indexOfDaemon = dict()
+        self.daemonOfIndex = []
+        # capacity version, changes whenever a node is added or resource is allocated/freed
+        self.version = 0
+        # (version, set of (N, C, W, B)) requirements that cannot be satisfied with the capacity version
+        self.unsatisfied = (0, set())
     
     def __str__(self):
         ans = ''
@@ -278,97 +501,165 @@ class SSCluster:
         n['hostname'] = hostname
         n['core'] = [-1]*CFG.CLUSTER['core_per_node']
         n['llcway'] = [-1]*CFG.CLUSTER['llcway_per_node']
+        n['freecore'] = (1 << CFG.CLUSTER['core_per_node']) - 1
+        n['freeway'] = (1 << CFG.CLUSTER['llcway_per_node']) - 1
         n['membw'] = CFG.CLUSTER['membw_per_node']
         n['mpi'] = 1
         n['tf'] = 1
         n['spark'] = 1
         self.nodes[daemon] = n
+        self.indexOfDaemon[daemon] = len(self.daemonOfIndex)
+        self.daemonOfIndex.append(daemon)
+        self.indexNode(daemon)
+        self.version += 1
+
+    # the key of the capacity index
+    def capacityKey(self, node):
+        return (popcount(node['freecore']), popcount(node['freeway']), node['membw'])
+
+    # the penalty of a node with the capacity key, must be the same as nodeSatisfyReq
+    def capacityPenalty(self, key):
+        cores, ways, membw = key
+        penalty = 0
+        penalty += (CFG.CLUSTER['core_per_node'] - cores)
+        penalty += 10*(CFG.CLUSTER['llcway_per_node'] - ways)
+        penalty += (CFG.CLUSTER['membw_per_node'] - membw)/CFG.CLUSTER['membw_per_node']
+        return penalty
+
+    # whether a node with the capacity key satisfies the per node requirement
+    def capacitySatisfy(self, key, req):
+        cores, ways, membw = key
+        return cores >= req['C'] and ways >= req['W'] and membw >= req['B']
+
+    # the capacity key after a nodeAlloc is freed (sign=1) or allocated (sign=-1)
+    def capacityAfter(self, key, nodeAlloc, sign):
+        cores, ways, membw = key
+        return (cores + sign*popcount(nodeAlloc['core']), ways + sign*popcount(nodeAlloc['llcway']), membw + sign*nodeAlloc['membw'])
+
+    # how many nodes satisfy the per node requirement
+    def countSatisfying(self, req):
+        cnt = 0
+        for key, bucket in self.capacity.items():
+            if self.capacitySatisfy(key, req):
+                cnt += len(bucket)
+        return cnt
+
+    # put a node into the capacity index
+    def indexNode(self, daemon):
+        key = self.capacityKey(self.nodes[daemon])
+        self.nodes[daemon]['capacity'] = key
+        if key not in self.capacity:
+            self.capacity[key] = []
+            self.capacityPenalties[key] = self.capacityPenalty(key)
+        insort(self.capacity[key], self.indexOfDaemon[daemon])
+
+    # remove a node from the capacity index, should be called before its resource changes
+    def unindexNode(self, daemon):
+        key = self.nodes[daemon]['capacity']
+        bucket = self.capacity[key]
+        del bucket[bisect_left(bucket, self.indexOfDaemon[daemon])]
+        if len(bucket) == 0:
+            self.capacity.pop(key)
+            self.capacityPenalties.pop(key)
 
     # check if the node can be use
     # return nodeAlloc and penalty
+    # nodeAlloc['core'] and nodeAlloc['llcway'] are bitmasks of the cores and llcways to use
     def nodeSatisfyReq(self, node, req):
         nosat = (None, None)
-        penalty = 0
-        nodeAlloc = dict() 
+        key = node['capacity']
+        cores, ways, membw = key
         # ennough core ?
-        nodeAlloc['core'] = []
-        if node['core'].count(-1) >= req['C']:
-            penalty += (CFG.CLUSTER['core_per_node'] - node['core'].count(-1)) # already used cores, add 1 for each used core
-            for i, c in enumerate(node['core']):
-                if len(nodeAlloc['core']) == req['C']:
-                    break
-                if c == -1:
-                    nodeAlloc['core'].append(i)
-        else:
+        if cores < req['C']:
             return nosat
         # enough llc ways ?
         # On current platform, the CAT requires available ways to be contigious
         # However, we will do this in the jobrunner.
         # Here we only record the 'abstract' usage of LLC ways
-        nodeAlloc['llcway'] = []
-        if node['llcway'].count(-1) >= req['W']:
-            penalty += 10*(CFG.CLUSTER['llcway_per_node'] - node['llcway'].count(-1)) # already used ways, add 10 for each used way
-            for i, c in enumerate(node['llcway']):
-                if len(nodeAlloc['llcway']) == req['W']:
-                    break
-                if c == -1:
-                    nodeAlloc['llcway'].append(i)
-        else:
+        if ways < req['W']:
             return nosat
         # enough memory bandwidth ?
-        if node['membw'] >= req['B']:
-            penalty += (CFG.CLUSTER['membw_per_node'] - node['membw'])/CFG.CLUSTER['membw_per_node'] # already used membw, add 1 for each used GB/s
-            nodeAlloc['membw'] = req['B']
-        else:
+        if membw < req['B']:
             return nosat
         # special types?
         # TODO special job types
         
-        return (nodeAlloc, penalty)
+        # use the available cores and ways with the lowest ids
+        nodeAlloc = dict()
+        nodeAlloc['core'] = lowestBits(node['freecore'], req['C'])
+        nodeAlloc['llcway'] = lowestBits(node['freeway'], req['W'])
+        nodeAlloc['membw'] = req['B']
+        # 1 for each used core, 10 for each used way, and the used fraction of membw
+        return (nodeAlloc, self.capacityPenalties[key])
 
     # mark resource as used
     def resourceAlloc(self, clusterAlloc, jobid):
+        self.version += 1
         for daemon, nodeAlloc, _ in clusterAlloc:
             node = self.nodes[daemon]
+            self.unindexNode(daemon)
             # alloc cores
-            for c in nodeAlloc['core']:
+            node['freecore'] &= ~nodeAlloc['core']
+            for c in bitsOf(nodeAlloc['core']):
                 node['core'][c] = jobid
             # alloc llc ways
-            for w in nodeAlloc['llcway']:
+            node['freeway'] &= ~nodeAlloc['llcway']
+            for w in bitsOf(nodeAlloc['llcway']):
                 node['llcway'][w] = jobid
             # alloc mem bw
             node['membw'] -= nodeAlloc['membw']
+            self.indexNode(daemon)
     
     def resourceFree(self, clusterAlloc):
+        self.version += 1
         for daemon, nodeAlloc, _ in clusterAlloc:
             node = self.nodes[daemon]
+            self.unindexNode(daemon)
             # free cores
-            for c in nodeAlloc['core']:
+            node['freecore'] |= nodeAlloc['core']
+            for c in bitsOf(nodeAlloc['core']):
                 node['core'][c] = -1
             # free llc ways
-            for w in nodeAlloc['llcway']:
+            node['freeway'] |= nodeAlloc['llcway']
+            for w in bitsOf(nodeAlloc['llcway']):
                 node['llcway'][w] = -1
             # free mem bw
             node['membw'] += nodeAlloc['membw']
+            self.indexNode(daemon)
 
     # search a nodelist that satisfies requriement
+    # nodes are scanned in the order they are added, until N zero-penalty nodes are found,
+    # then the N least penalty nodes (in the scanned ones) are used
     def search(self, N, perNodeReq):
-        ans = []
-        zero_penalty = 0
-        for daemon, node in self.nodes.items():
-            nodeAlloc, penalty = self.nodeSatisfyReq(node, perNodeReq)
-            if nodeAlloc:
-                ans.append((daemon, nodeAlloc, penalty))
-                if penalty == 0:
-                    zero_penalty += 1
-            if zero_penalty >= N:
-                break
-        if len(ans) >= N:
-            # use the penalty to sort and use the least penalty nodes
-            ans.sort(key=lambda x: x[2])
-            clusterAlloc = ans[0:N]
+        if self.unsatisfied[0] != self.version:
+            self.unsatisfied = (self.version, set())
+        req = (N, perNodeReq['C'], perNodeReq['W'], perNodeReq['B'])
+        if req in self.unsatisfied[1]:
+            return None
+        # satisfying buckets with their penalty
+        buckets = []
+        for key, bucket in self.capacity.items():
+            if self.capacitySatisfy(key, perNodeReq):
+                buckets.append((self.capacityPenalties[key], bucket))
+        # the scan stops at the N-th zero-penalty node
+        zeros = [bucket for penalty, bucket in buckets if penalty == 0]
+        cutoff = None
+        if sum([len(bucket) for bucket in zeros]) >= N:
+            cutoff = next(itertools.islice(heapq.merge(*zeros), N-1, None))
+        # each bucket gives a sorted stream of (penalty, node index)
+        streams = []
+        cnt = 0
+        for penalty, bucket in buckets:
+            end = len(bucket) if cutoff is None else bisect_right(bucket, cutoff)
+            streams.append(zip(itertools.repeat(penalty), itertools.islice(bucket, end)))
+            cnt += end
+        if cnt >= N:
+            clusterAlloc = []
+            for _, index in itertools.islice(heapq.merge(*streams), N):
+                daemon = self.daemonOfIndex[index]
+                nodeAlloc, penalty = self.nodeSatisfyReq(self.nodes[daemon], perNodeReq)
+                clusterAlloc.append((daemon, nodeAlloc, penalty))
             return clusterAlloc
         else:
+            self.unsatisfied[1].add(req)
             return None
-
-
@@ -0,0 +1,109 @@
+import json
+import gzip
+import time
+import queue
+import threading
+from SSconfig import SSConfig as CFG
+
+'''
+The job history file, a line 'JOBID %5d: {json}' per finished job.
+The allocation of a record is kept compact, each node's core map is stored once (it is also the
+affinity of the host), and the job attributes once for the record:
+  'jobid': jobid,
+  'alloc': {'daemons': [daemon of each node], 'hosts': [hostname of each node],
+            'coremaps': [core map of each node], 'llcwaymaps': [way map of each node],
+            'leadnode': leadnode, 'toprofile': toprofile}
+instead of 'allocation', a list of (daemon, jobspec), see expandRecord.
+A file ending with .gz is gzip compressed, one gzip member per flush.
+'''
+# a compact copy of a history record, taken when the job finishes so later changes of the cluster are not seen
+def compactRecord(jobid, record, hostOf):
+    rec = dict([(k, v) for k, v in record.items() if k != 'allocation'])
+    allocation = record['allocation']
+    rec['jobid'] = jobid
+    rec['alloc'] = {
+        'daemons': [daemon for daemon, _ in allocation],
+        'hosts': [hostOf(daemon) for daemon, _ in allocation],
+        'coremaps': [list(jobspec['coremap']) for _, jobspec in allocation],
+        'llcwaymaps': [list(jobspec['llcwaymap']) for _, jobspec in allocation],
+        'leadnode': allocation[0][1]['leadnode'],
+        'toprofile': allocation[0][1]['toprofile'],
+    }
+    return rec
+
+# the record as it is in SSDatabase.history
+def expandRecord(rec):
+    if 'alloc' not in rec:
+        return rec
+    alloc = rec['alloc']
+    affinity = dict(zip(alloc['hosts'], alloc['coremaps']))
+    record = dict([(k, v) for k, v in rec.items() if k not in ['alloc', 'jobid']])
+    record['allocation'] = []
+    for daemon, coremap, llcwaymap in zip(alloc['daemons'], alloc['coremaps'], alloc['llcwaymaps']):
+        record['allocation'].append((daemon, {
+            'jobid': rec['jobid'],
+            'jobattr': rec['jobattr'],
+            'coremap': coremap,
+            'llcwaymap': llcwaymap,
+            'leadnode': alloc['leadnode'],
+            'toprofile': alloc['toprofile'],
+            'affinity': affinity,
+        }))
+    return record
+
+# the jobid and the record of a line of the history file
+def parseLine(line):
+    job = json.loads(line[line.index(':')+1:])
+    jobid = job['jobid'] if 'jobid' in job else job['allocation'][0][1]['jobid']
+    return (jobid, job)
+
+def openHistory(fname, mode='r'):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode + 't')
+    return open(fname, mode)
+
+'''
+SSHistoryWriter appends the records from a background thread.
+Lines are buffered and written CFG.DB['history_flush_records'] at a time,
+or after CFG.DB['history_flush_seconds'], whichever comes first.
+'''
+class SSHistoryWriter(threading.Thread):
+    def __init__(self, fname):
+        super().__init__(daemon=True)
+        self.fname = fname
+        self.records = queue.Queue()
+        self.closed = False
+        self.start()
+
+    def write(self, jobid, rec):
+        self.records.put((jobid, rec))
+
+    def run(self):
+        lines = []
+        deadline = None
+        done = False
+        while not done:
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                item = self.records.get(timeout=timeout)
+                if item is None:
+                    done = True
+                else:
+                    lines.append('JOBID %5d: %s\n' % (item[0], json.dumps(item[1])))
+                    if deadline is None:
+                        deadline = time.time() + CFG.DB['history_flush_seconds']
+            except queue.Empty:
+                pass
+            if len(lines) and (done or len(lines) >= CFG.DB['history_flush_records'] or time.time() >= deadline):
+                with openHistory(self.fname, 'a') as fw:
+                    fw.write(''.join(lines))
+                lines = []
+                deadline = None
+
+    # write all buffered records, no more can be written
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.records.put(None)
+        self.join()
@@ -1,12 +1,33 @@
 import numpy as np
 from datetime import datetime
+from SStrace import cachedArray
 
 def getTimestamp(timestr):
     # 2016-02-02 06:53:00-07:00
     d = datetime.strptime(timestr, '%Y-%m-%d %H:%M:%S%z')
     return d.timestamp()
 
-def genJobs(N=10, light_rato=0.7):
+# getTimestamp of an array of time strings
+# the strings of the form above are converted at once, the others by getTimestamp, which raises if it cannot
+def getTimestamps(timestrs):
+    timestrs = np.asarray(timestrs, dtype=str)
+    out = np.zeros(len(timestrs))
+    regular = np.char.str_len(timestrs) == 25
+    chars = timestrs[regular].astype('U25').view('U1').reshape(-1, 25)
+    # the separators of '2016-02-02 06:53:00-07:00', the digits are checked by the conversions
+    regular[regular] = np.all(chars[:, [4, 7, 10, 13, 16, 22]] == np.array(['-', '-', ' ', ':', ':', ':']), axis=1) \
+        & np.isin(chars[:, 19], ['+', '-']) & np.all(np.char.isdigit(chars[:, [20, 21, 23, 24]]), axis=1)
+    chars = timestrs[regular].astype('U25').view('U1').reshape(-1, 25)
+    local = timestrs[regular].astype('U19').astype('datetime64[s]').astype(np.int64)
+    hhmm = chars[:, [20, 21, 23, 24]].astype(np.int64)
+    offset = (hhmm[:, 0]*10 + hhmm[:, 1])*3600 + (hhmm[:, 2]*10 + hhmm[:, 3])*60
+    sign = np.where(chars[:, 19] == '-', -1, 1)
+    out[regular] = local - sign*offset
+    out[~regular] = [getTimestamp(timestr) for timestr in timestrs[~regular]]
+    return out
+
+# rng (np.random.default_rng(seed)) makes the programs reproducible, np.random is used without it
+def genJobs(N=10, light_rato=0.7, rng=None):
     #progs = ['HH', 'LH', 'HL', 'LL']
     progs = ['lu-16', 'cg-16', 'mg-16', 'ep-16']
     #progs = ['bw-28', 'bw-28', 'bw-28', 'hc-28']
@@ -14,78 +35,58 @@ def genJobs(N=10, light_rato=0.7):
     ratio = np.array([1, 1, 1, 3*y/(1-y)]) # ratio for all
     probs = ratio/ratio.sum()
     #print(probs)
-    jobs = np.random.choice(progs, size=N, p=probs)
+    jobs = (rng if rng is not None else np.random).choice(progs, size=N, p=probs)
     #print(jobs)
     return jobs
 
-def convert_trinity_trace(light_rato=0.5):
-    job_info = [] 
-    time_bias = -1
-    with open('../../trinity_formatted_release_v0.1.0.csv', 'r') as fr:
-        head = True
-        for line in fr:
-            if head:
-                head = False
-                continue
-            # 0 user_ID, 1 group_ID, 2 submit_time, 3 start_time, 4 dispatch_time, 5 queue_time, 6 end_time,
-            # 7 wallclock_limit, 8 job_status, 9 node_count, 10 tasks_requested
-            ss = line.strip().split(',')
-            if len(ss) < 1:
-                break
-            if ss[8] != 'JOBEND' or int(ss[10]) == 1:
-                continue 
-            st = getTimestamp(ss[2]) # submit time
-            if time_bias < 0 or st < time_bias:
-                time_bias = st
-            dr = getTimestamp(ss[6])-getTimestamp(ss[3]) # duration
-            nproc = int(ss[10])*28//32 # scale to bic config
-            if nproc > 28 and nproc % 28 != 0:
-                continue
-            # construt the tuple (nproc, st, dr), then combine with prog in {HH, LH, HL, LL} (membw-llc)
-            job_info.append((nproc, st, dr))
-    job_name = genJobs(len(job_info), light_rato=light_rato) 
-    trace = [(jobname, s[0], int(s[1]-time_bias), int(s[2])) for jobname, s in zip(job_name, job_info)]
-    with open('trinity_trace.txt', 'w') as fw:
-        for t in trace:
-            fw.write(','.join([str(x) for x in t]))
-            fw.write('\n')
-    print('log %d traces' % len(trace))
+# the columns of a LANL csv (header skipped) as arrays of strings
+def readColumns(fname, usecols):
+    cols = np.loadtxt(fname, delimiter=',', dtype=str, skiprows=1, usecols=usecols, ndmin=2, comments=None)
+    return [cols[:, i] for i in range(len(usecols))]
+
+# jobs of a LANL trace as (nproc, submit, duration), the submit times from the first one
+# status: the status of the jobs to keep; scale(tasks) -> nproc; ppn: jobs larger than a node have whole nodes
+# the first submit time is taken before the jobs are filtered by nproc, as the original conversion did
+def convertColumns(status, tasks, submit, start, end, okStatus, scale, ppn):
+    keep = (status == okStatus) & (tasks != 1)
+    keep &= (np.char.str_len(submit) > 0) & (np.char.str_len(start) > 0) & (np.char.str_len(end) > 0)
+    st = getTimestamps(submit[keep])
+    dr = getTimestamps(end[keep]) - getTimestamps(start[keep])
+    nproc = scale(tasks[keep])
+    time_bias = st.min() if len(st) else 0
+    whole = (nproc <= ppn) | (nproc % ppn == 0)
+    arr = np.zeros(np.count_nonzero(whole), dtype=[('nproc', 'i8'), ('submit', 'i8'), ('duration', 'i8')])
+    arr['nproc'] = nproc[whole]
+    arr['submit'] = (st[whole] - time_bias).astype(np.int64)
+    arr['duration'] = dr[whole].astype(np.int64)
+    return arr
+
+# write the trace of a converted csv (see convertColumns), with programs drawn by genJobs
+# the tuple (nproc, st, dr) is combined with prog in {HH, LH, HL, LL} (membw-llc)
+def writeTrace(jobs, outname, light_rato, seed):
+    rng = np.random.default_rng(seed) if seed is not None else None
+    job_name = genJobs(len(jobs), light_rato=light_rato, rng=rng)
+    with open(outname, 'w') as fw:
+        fw.writelines(['%s,%d,%d,%d\n' % t for t in zip(job_name.tolist(), jobs['nproc'].tolist(), jobs['submit'].tolist(), jobs['duration'].tolist())])
+    print('log %d traces' % len(jobs))
+
+# the csv is parsed once, the jobs are cached next to it, so converting again (e.g. for another light ratio) is fast
+def convert_trinity_trace(light_rato=0.5, seed=None, fname='../../trinity_formatted_release_v0.1.0.csv', outname='trinity_trace.txt'):
+    # 0 user_ID, 1 group_ID, 2 submit_time, 3 start_time, 4 dispatch_time, 5 queue_time, 6 end_time,
+    # 7 wallclock_limit, 8 job_status, 9 node_count, 10 tasks_requested
+    def parse():
+        submit, start, end, status, tasks = readColumns(fname, (2, 3, 6, 8, 10))
+        return convertColumns(status, tasks.astype(np.int64), submit, start, end, 'JOBEND',
+                lambda tasks: tasks*28//32, 28) # scale to bic config
+    writeTrace(cachedArray(fname, [('jobs', '')], parse), outname, light_rato, seed)
     
-def convert_mustang_trace(light_rato=0.5):
-    job_info = [] 
-    time_bias = -1
-    with open('../../mustang_release_v0.2.0.csv', 'r') as fr:
-        head = True
-        for line in fr:
-            if head:
-                head = False
-                continue
-            # 0 user_ID, 1 group_ID, 2 submit_time, 3 start_time, 4 end_time, 5 wallclock_limit, 6 job_status, 7 node_count, 8 tasks_requested
-            ss = line.strip().split(',')
-            if len(ss) < 1:
-                break
-            if ss[6] != 'COMPLETED' or int(ss[8]) == 1:
-                continue 
-            if len(ss[2])*len(ss[3])*len(ss[4]) == 0:
-                continue
-            st = getTimestamp(ss[2]) # submit time
-            if time_bias < 0 or st < time_bias:
-                time_bias = st
-            dr = getTimestamp(ss[4])-getTimestamp(ss[3]) # duration
-            nproc = int(ss[8])
-            if nproc > 24 and nproc % 24 != 0:
-                continue
-            # construt the tuple (nproc, st, dr), then combine with prog in {HH, LH, HL, LL} (membw-llc)
-            job_info.append((nproc, st, dr))
-            #if len(job_info) >= 1000:
-            #    break
-    job_name = genJobs(len(job_info), light_rato=light_rato) 
-    trace = [(jobname, s[0], int(s[1]-time_bias), int(s[2])) for jobname, s in zip(job_name, job_info)]
-    with open('mustang_trace.txt', 'w') as fw:
-        for t in trace:
-            fw.write(','.join([str(x) for x in t]))
-            fw.write('\n')  
-    print('log %d traces' % len(trace))
+def convert_mustang_trace(light_rato=0.5, seed=None, fname='../../mustang_release_v0.2.0.csv', outname='mustang_trace.txt'):
+    # 0 user_ID, 1 group_ID, 2 submit_time, 3 start_time, 4 end_time, 5 wallclock_limit, 6 job_status, 7 node_count, 8 tasks_requested
+    def parse():
+        submit, start, end, status, tasks = readColumns(fname, (2, 3, 4, 6, 8))
+        return convertColumns(status, tasks.astype(np.int64), submit, start, end, 'COMPLETED',
+                lambda tasks: tasks, 24)
+    writeTrace(cachedArray(fname, [('jobs', '')], parse), outname, light_rato, seed)
 
 if __name__ == '__main__':
     heavy_jobs = ['bw-16', 'mg-16', 'lu-16', 'cg-16', 'gan-16', 'ts-16', 'nw-16'] 
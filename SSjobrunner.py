@@ -5,6 +5,8 @@ import numpy
 import random
 from SSlogger import SSLogger
 from SSconfig import SSConfig as CFG
+from SScat import getCatBackend, catLayout
+from SSprofile import curveOfSamples, interpolate, toLists
 
 class SSJobBinder(threading.Thread):
     def __init__(self, name, corelist):
@@ -18,59 +20,35 @@ class SSJobBinder(threading.Thread):
             print(ss)
 
 class SSJobRunner(threading.Thread):
-    def __init__(self, hostname, jobspec, name='JobRunner'):
+    def __init__(self, hostname, jobspec, name='JobRunner', onFinish=None, sampler=None):
         super().__init__()
         self.jobspec = jobspec
         self.hostname = hostname
         self.logger = SSLogger(name)
         # results for parent
         self.returns = dict()
+        # called with the runner when the job finishes, from the runner thread
+        self.onFinish = onFinish
+        # the daemon's SSSampler, pushes (ways, ipc, membw) samples while the job is profiled
+        self.sampler = sampler
+        self.samples = []
     # cores[i] = jobid, jobid uses this i-th core
     # ways[i] = jobid, jobid uses this i-th way
-    # return a string for CAT 'pqos -s; pqos -a', e.g.
-    # sudo pqos -e "llc:1=0xffff0;llc:2=0x0000f"
-    # sudo pqos -a "llc:1=0-7;llc:2=8-27" # bic03,bic04
-    def getCATString(self, cores, ways):
+    # return the CAT layout for the node, see SScat.catLayout
+    def getCATLayout(self, cores, ways):
         self.logger.debug('cores:', cores)
         self.logger.debug('ways:', ways)
-        jobids = set(ways) # what jobs are explicitly using LLC
-        if -1 in jobids:
-            jobids.remove(-1) # -1 means no job
-        if len(jobids) == 0: # no CAT, reset. For LLC-unaware policies like CE and CS
-            return [['ssh', 'root@' + self.hostname, 'pqos -R']]
-        # give the spare ways to jobs
-        jobids = list(jobids)
-        for i, jid in enumerate(ways):
-            if jid == -1:
-                ways[i] = jobids[i % len(jobids)]
-        # sort the ways with jobid to make each COS use contigious range
-        ways.sort()
-        # make CAT decision
-        cos = []
-        for jobid in jobids:
-            cos.append({'cores': [], 'ways': []})
-            for c, jid in enumerate(cores):
-                if jobid == jid:
-                    cos[-1]['cores'].append(c)
-            for w, jid in enumerate(ways):
-                if jobid == jid:
-                    cos[-1]['ways'].append(w)
-        pqosE = []
-        pqosA = []
-        for i, c in enumerate(cos):
-            s = hex(int(''.join(['1' if x in c['ways'] else '0' for x in range(19,-1,-1)]), 2))
-            pqosE.append('llc:%d=%s' % (i+1, s))
-            pqosA.append('llc:%d=%s' % (i+1, ','.join(str(x) for x in c['cores'])))
-        pqosEcmd = 'pqos -e "%s"' % (';'.join(pqosE))
-        pqosAcmd = 'pqos -a "%s"' % (';'.join(pqosA))
-        return [['ssh', 'root@' + self.hostname, pqosEcmd], ['ssh', 'root@' + self.hostname, pqosAcmd]]
+        # the jobs keep their COS ids on the node, so only the COS that changed are programmed
+        return catLayout(cores, ways, getCatBackend().cosIds)
 
     # the command use to launch the program
+    # return (extra env vars, command, working directory), the directory is None to use the current one
+    # nothing process-wide is changed, so several runners can launch at the same time
     def getLaunchString(self, jobspec):
         fm = jobspec['jobattr']['framework']
         if fm == 'MPI' or fm == 'Spark':
             if jobspec['leadnode'] != self.hostname:
-                return (None, None)
+                return (None, None, None)
         elif fm == 'TensorFlow':
             assert(len(jobspec['affinity']) == 1)
             pass
@@ -83,6 +61,7 @@ class SSJobRunner(threading.Thread):
                     affs[host].append(str(c))
 
         envs = dict()
+        cwd = None
         # running commands
         # format prog-nproc, e.g. mg-16, bfs-32
         prog, nproc = jobspec['jobattr']['jobname'].split('-')
@@ -121,8 +100,8 @@ class SSJobRunner(threading.Thread):
             for host, corelist in affs.items():
                 exeCmd.extend(['-host', host, '-env', 'I_MPI_PIN_PROCESSOR_LIST=%s' % ','.join(corelist), '-n', str(len(corelist)), exePath, ':'])
             exeCmd.pop(-1)
-            # TODO, wrap the jobs and move this cd operation to wrapper scripts
-            os.chdir(CFG.RUN['exe_dir'][prog])
+            # the programs have to run in their own directories
+            cwd = CFG.RUN['exe_dir'][prog]
         elif prog in ['gan', 'rnn']: # two tensorflow programs
             exePath = CFG.RUN['exe_path'][prog]
             assert(len(affs) == 1) # should run on only one node
@@ -132,71 +111,56 @@ class SSJobRunner(threading.Thread):
         else:
             assert(False)
 
-        return (envs, exeCmd)
+        return (envs, exeCmd, cwd)
     
-    def getProfileString(self, jobspec):
-        if not jobspec['toprofile'] or jobspec['leadnode'] != self.hostname:
-            return None
-        return [CFG.RUN['deploy_path'] + 'SSmonitor.py'] 
+    # the job is profiled on its lead node
+    def needProfile(self, jobspec):
+        return jobspec['toprofile'] and jobspec['leadnode'] == self.hostname
+
+    def addSample(self, w, ipc, mbw):
+        self.samples.append((w, ipc, mbw))
 
     def run(self):
+        try:
+            self.runJob()
+        finally:
+            if self.onFinish:
+                self.onFinish(self)
+
+    def runJob(self):
         #self.logger.warn(self.jobspec)
         jobname = self.jobspec['jobattr']['jobname']
         self.logger.debug('Run:', jobname)
-        # CAT configuration
-        catCmds = self.getCATString(self.jobspec['coremap'], self.jobspec['llcwaymap'])
-        for catCmd in catCmds:
-            #self.logger.warn('CAT CMD:', ' '.join(catCmd))
-            #subprocess.run(catCmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            subprocess.run(catCmd, stdout=subprocess.DEVNULL)
-        # start the profiler (if needed)
-        profCmd = self.getProfileString(self.jobspec)
-        if profCmd:
-            self.logger.debug('PROF CMD:', ' '.join(profCmd))
-            #pPorfiler = subprocess.Popen(profCmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-            pPorfiler = subprocess.Popen(profCmd, stdout=subprocess.PIPE)
+        # CAT configuration, only the changes to the node's layout are programmed
+        # the job still runs if CAT cannot be programmed, the layout is tried again by the next job
+        try:
+            getCatBackend().apply(self.getCATLayout(self.jobspec['coremap'], self.jobspec['llcwaymap']))
+        except Exception as e:
+            self.logger.error('CAT not programmed for %s:' % jobname, repr(e))
+        # start profiling (if needed)
+        toProfile = self.needProfile(self.jobspec) and self.sampler is not None
+        if toProfile:
+            self.logger.debug('PROF start')
+            self.sampler.attach(self.addSample)
         # run the executable
-        evns, exeCmd = self.getLaunchString(self.jobspec)
-        if evns:
-            for k, v in evns.items():
-                os.environ[k] = v
+        evns, exeCmd, cwd = self.getLaunchString(self.jobspec)
         if exeCmd:
+            # the env of the daemon with the job's own vars, only for this launch
+            env = dict(os.environ)
+            if evns:
+                env.update(evns)
             self.logger.debug('EXE CMD:', ' '.join(exeCmd))
-            pRun = subprocess.run(exeCmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            pRun = subprocess.run(exeCmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env, cwd=cwd)
             #pRun = subprocess.run(exeCmd, stdout=subprocess.DEVNULL)#, stderr=subprocess.DEVNULL)
             self.returns['exitcode'] = pRun.returncode
             self.logger.debug('EXE Done:', exeCmd)
-            # back to deploy path
-            os.chdir(CFG.RUN['deploy_path'])
-        # terminate the profiler, sort out the result, and return to daemon to be sent to master
-        if profCmd:
+        # stop profiling, sort out the result, and return to daemon to be sent to master
+        if toProfile:
             self.logger.debug('check profile results')
-            pPorfiler.terminate()
-            # llcway ipc mbw
-            ipcs, mbws = [], []
-            for _ in range(0, 1+CFG.CLUSTER['llcway_per_node']):
-                ipcs.append([])
-                mbws.append([])
-            for line in pPorfiler.stdout:
-                ss = line.decode('utf-8').strip().split()
-                #self.logger.debug(line)
-                if len(ss) != 3:
-                    break
-                w, ipc, mbw = int(ss[0]), float(ss[1]), float(ss[2])
-                ipcs[w].append(ipc)
-                mbws[w].append(mbw)
-            for w in range(0, 1+CFG.CLUSTER['llcway_per_node']):
-                ipcs[w] = numpy.average(ipcs[w]) if len(ipcs[w]) else -1
-                mbws[w] = numpy.average(mbws[w]) if len(mbws[w]) else -1
-            # linear interpolation
-            # self.logger.warn(CFG.PROF['sample_ways'])
-            for i in range(0, len(CFG.PROF['sample_ways'])-1):
-                cur_w, next_w = CFG.PROF['sample_ways'][i], CFG.PROF['sample_ways'][i+1]
-                #self.logger.warn('cur_w %d, next_w %d' % (cur_w, next_w))
-                for k in range(min(cur_w, next_w) + 1, max(cur_w, next_w)):
-                    #self.logger.warn(k, ipcs)
-                    ipcs[k] = ipcs[next_w] + (ipcs[cur_w]-ipcs[next_w])/(cur_w-next_w) * (k-next_w)
-                    mbws[k] = mbws[next_w] + (mbws[cur_w]-mbws[next_w])/(cur_w-next_w) * (k-next_w)
+            self.sampler.detach(self.addSample)
+            # the average for each ways, then linear interpolation between the ways actually sampled
+            curve = interpolate(curveOfSamples(self.samples))
+            ipcs, mbws = toLists(curve)
             self.logger.warn(ipcs)
                     
             self.returns['ipcs'] = ipcs
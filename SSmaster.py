@@ -1,20 +1,22 @@
 #!/usr/bin/python3
 import time
+import asyncio
 import os
 import sys
-from SSnetwork import SSMasterNetwork
+from SSnetwork import SSMasterNetwork, SSAsyncMasterNetwork
 from SSdatabase import SSDatabase 
 from SSscheduler import SSScheduler
 from SSprotocol import SSProtocol
 from SSlogger import SSLogger
 from SSparser import SSParser
+from SSconfig import SSConfig as CFG
 
 class SSMaster:
-    def __init__(self, algoname='CE', alpha=0.9):
+    def __init__(self, algoname='CE', alpha=0.9, backfill='none'):
         self.MIN_DAEMONS = 8
-        self.net = SSMasterNetwork()
+        self.net = self.createNetwork()
         self.db = SSDatabase(algorithm=algoname)
-        self.sched = SSScheduler(algoname=algoname, database=self.db)
+        self.sched = SSScheduler(algoname=algoname, database=self.db, backfill=backfill)
         self.default_alpha = alpha
         self.prtl = SSProtocol()
         self.logger = SSLogger('Master')
@@ -22,6 +24,9 @@ class SSMaster:
         self.users = []
         self.daemons = []
     
+    def createNetwork(self):
+        return SSMasterNetwork()
+
     def isclean(self):
         if len(self.db.pendingJobs) or len(self.db.runningJobs):
             return False
@@ -47,54 +52,134 @@ class SSMaster:
     
     # the main loop
     def run(self):
-        # try to get new message
+        # try to get new message, then handle all messages already arrived
         client, msg = self.net.recvObj(timeout=1)
-        if client: # acts accordingly
-            # connection broken
-            if msg == self.net.CONNECTION_BROKEN: # client lost
-                if client in self.users:
-                    self.users.remove(client)
-                if client in self.daemons:
-                    self.logger.error('No handle for daemon lost !!')
-                    self.daemons.remove(client)
-                    #TODO database remove, scheduler reschedule
-            # normal messages
-            #self.logger.echo(msg)
-            if self.prtl.isgreeting(msg): # new client
-                if msg['role'] == 'user':
-                    self.logger.debug('New User from', client)
-                    self.users.append(client) # user for interaction
-                elif msg['role'] == 'daemon':
-                    self.logger.debug('New Daemon from', client)
-                    self.daemons.append(client) # daemon run on each job
-                    self.db.addDaemon(client, msg['hostname'])
-            elif self.prtl.isjobfinish(msg):
-                # NOTE, only one daemon of the job finish, need all finish to really finish
-                self.db.daemonFinishJob(client, msg['jobid'], msg['returns']) 
+        while client:
+            self.handleMessage(client, msg)
+            client, msg = self.net.recvObj(timeout=0)
+        self.schedule()
+
+    # place all jobs that can start now
+    def schedule(self):
         # wait for all daemons 
         if len(self.daemons) < self.MIN_DAEMONS:
             return
         # try to schedule jobs, ignore the estimate time
-        allocation, _ = self.sched.nextJob()
-        #self.logger.debug(allocation)
-        if allocation:
+        # all jobs that can start are placed in one round, and the NewJob messages are sent per daemon
+        newjobs = dict()
+        for allocation, _ in self.sched.scheduleRound():
+            #self.logger.debug(allocation)
             for daemon, jobspec in allocation:
                 #self.logger.echo(daemon, jobspec)
-                self.net.sendObjTo(daemon, self.prtl.newjob(jobspec))
+                if daemon not in newjobs:
+                    newjobs[daemon] = []
+                newjobs[daemon].append(self.prtl.newjob(jobspec))
+        for daemon, msgs in newjobs.items():
+            self.net.sendObjsTo(daemon, msgs)
+
+    # acts accordingly
+    def handleMessage(self, client, msg):
+        # connection broken
+        if msg == self.net.CONNECTION_BROKEN: # client lost
+            if client in self.users:
+                self.users.remove(client)
+            if client in self.daemons:
+                self.logger.error('No handle for daemon lost !!')
+                self.daemons.remove(client)
+                #TODO database remove, scheduler reschedule
+            return
+        # normal messages
+        #self.logger.echo(msg)
+        if self.prtl.isgreeting(msg): # new client
+            # use length framing if both support it
+            if self.prtl.framingof(msg) == 'length' and CFG.NET['framing'] == 'length':
+                self.net.setFraming(client, 'length')
+                self.net.sendObjTo(client, self.prtl.greeting('master', self.net.hostname, 'length'))
+            if msg['role'] == 'user':
+                self.logger.debug('New User from', client)
+                self.users.append(client) # user for interaction
+            elif msg['role'] == 'daemon':
+                self.logger.debug('New Daemon from', client)
+                self.daemons.append(client) # daemon run on each job
+                self.db.addDaemon(client, msg['hostname'])
+        elif self.prtl.isjobfinish(msg):
+            # NOTE, only one daemon of the job finish, need all finish to really finish
+            self.db.daemonFinishJob(client, msg['jobid'], msg['returns']) 
+
+'''
+SSAsyncMaster runs the master on an asyncio event loop instead of polling.
+Messages are handled as they arrive on each connection, and scheduling is triggered by them
+(daemon join, job finish), all messages handled in the same loop iteration trigger one round.
+While jobs are pending, a timer retries at the next time the priority order may change.
+'''
+class SSAsyncMaster(SSMaster):
+    def __init__(self, algoname='CE', alpha=0.9, backfill='none'):
+        super().__init__(algoname=algoname, alpha=alpha, backfill=backfill)
+        self.loop = None
+        self.scheduleQueued = False
+        self.retryTimer = None
+        self.finished = None
+
+    def createNetwork(self):
+        return SSAsyncMasterNetwork(self.handleObject)
+
+    # serve until all jobs finish
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.finished = self.loop.create_future()
+        await self.net.start()
+        self.scheduleSoon()
+        await self.finished
+        if self.retryTimer:
+            self.retryTimer.cancel()
+        self.net.close()
+
+    def handleObject(self, client, msg):
+        self.handleMessage(client, msg)
+        self.scheduleSoon()
+
+    # coalesce the triggers into one scheduling round
+    def scheduleSoon(self):
+        if not self.scheduleQueued:
+            self.scheduleQueued = True
+            self.loop.call_soon(self.scheduleNow)
+
+    def scheduleNow(self):
+        self.scheduleQueued = False
+        self.schedule()
+        if self.isclean():
+            if not self.finished.done():
+                self.finished.set_result(True)
+            return
+        # nothing else may start the head job before the priority order changes
+        if self.retryTimer:
+            self.retryTimer.cancel()
+            self.retryTimer = None
+        ts = self.db.nextPriorityChange() if len(self.db.pendingJobs) else None
+        if ts is not None:
+            delay = max(1, ts - self.db.getTimestampNow())
+            self.retryTimer = self.loop.call_later(delay, self.scheduleSoon)
         
 if __name__ == '__main__':
     if len(sys.argv) < 4:
-        print('Usage: ./SSmaster.py Algo(CE/CS/SS) JOB_SEQUENCE ALPHA')
+        print('Usage: ./SSmaster.py Algo(CE/CS/SS) JOB_SEQUENCE ALPHA [BACKFILL(none/easy)] [LOOP(poll/async)]')
     sched_algo = sys.argv[1].strip()
     job_sequence = sys.argv[2].strip()
     alpha = float(sys.argv[3])
-    print('Going to use %s algorithm (alpha=%.2f) for jobs: %s' % (sched_algo, alpha, job_sequence))
+    backfill = sys.argv[4].strip() if len(sys.argv) > 4 else 'none'
+    loopmode = sys.argv[5].strip() if len(sys.argv) > 5 else 'poll'
+    print('Going to use %s algorithm (alpha=%.2f, backfill=%s, loop=%s) for jobs: %s' % (sched_algo, alpha, backfill, loopmode, job_sequence))
 
-    master = SSMaster(algoname=sched_algo, alpha=alpha)
+    masterClass = SSAsyncMaster if loopmode == 'async' else SSMaster
+    master = masterClass(algoname=sched_algo, alpha=alpha, backfill=backfill)
     master.addJobSequence(job_sequence)
     master.logger.succ('Master started, will schedule jobs after daemons connected.')
     while not master.isclean():
         master.run() 
+    master.db.close() # all the history is written
     bs = master.parse()
     jobcnt = len(master.parser.records)
     header = '%30s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%s' % ('Algo', 'ALPHA', 'OCC(%)', 'MAX_TURN', 'USE_CH', 'BUB_CH', 'JOB_WAIT', 'JOB_RUN', 'HISTORY_FILE')
@@ -110,6 +195,8 @@ if __name__ == '__main__':
         master.db.historyFilename)
     print(header)
     print(result)
+    if backfill != 'none':
+        print('%d jobs backfilled' % bs['backfilled_jobs'])
 
     with open('results.txt', 'a+') as fw:
         fw.write('Algorithm %s JobSequence %s\n' % (sched_algo, job_sequence))
@@ -5,38 +5,343 @@ Modification is required for other platforms.
 '''
 import subprocess
 import socket
+import threading
+import queue
+import random
+import math
+import time
 import numpy as np
+from SSlogger import SSLogger
 from SSconfig import SSConfig as CFG
+from SScat import getCatBackend
 
-intvl_s = 5
-mon_cmd = 'ssh root@%s perf stat -a -x, -e \
-instructions,cycles,\
-uncore_ha_0/event=0x01,umask=0x03/,uncore_ha_1/event=0x01,umask=0x03/,uncore_ha_0/event=0x01,umask=0x0C/,uncore_ha_1/event=0x01,umask=0x0C/ \
-sleep %d' % (socket.gethostname(), intvl_s)
-
-def get_value():
-    p1 = subprocess.run(mon_cmd.split(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, bufsize=1)
-    buf1 = [float(s.strip().split(',')[0]) for s in p1.stderr.decode('utf-8').strip().split('\n')]
-    # parse output
-    v_ips = buf1[0]/intvl_s*1e-9
-    v_cps = buf1[1]/intvl_s*1e-9
-    v_membw = sum(buf1[-4:])*1e-9*64/intvl_s
-    return (v_ips/v_cps, v_membw)
-
-def set_cat(w=CFG.CLUSTER['llcway_per_node']):
-    b = ['1']*w
-    inv_b = ['1']*(CFG.CLUSTER['llcway_per_node']-w)
-    inv_b.extend(['0']*w)
-    h = hex(int(''.join(b), 2))
-    inv_h = hex(int(''.join(inv_b), 2))
-    if w == CFG.CLUSTER['llcway_per_node']:
-        pqosEcmd = 'pqos -R'
-        subprocess.run(['ssh', 'root@'+socket.gethostname(), pqosEcmd], stdout=subprocess.DEVNULL)
-    else:
-        pqosEcmd = 'pqos -e "llc:1=%s;llc:2=%s"' % (h, inv_h)
-        pqosAcmd = 'pqos -a "llc:1=0-15;llc:2=16-27"'
-        subprocess.run(['ssh', 'root@'+socket.gethostname(), pqosEcmd, '&&', pqosAcmd], stdout=subprocess.DEVNULL)
+'''
+The counter sources, read() blocks until the next interval and returns its counts
+{'instructions', 'cycles', 'membytes', 'seconds'}, or None if the source is closed.
+'''
+# one streaming 'perf stat -I' for the whole life of the source
+class SSPerfSource:
+    hardware = True
+    def __init__(self):
+        self.logger = SSLogger('PerfSource')
+        self.events = CFG.PROF['perf_events']
+        self.intervalMs = CFG.PROF['interval_ms']
+        self.proc = None
+        # the completed intervals, filled by the reader thread
+        # a window only reads the intervals after sync(), so the oldest are dropped while nobody reads
+        self.intervals = queue.Queue(maxsize=CFG.PROF['sample_intervals'] + 2)
+
+    def open(self):
+        perfCmd = 'perf stat -a -x, -I %d -e %s' % (self.intervalMs, ','.join(self.events))
+        prefix = CFG.PROF['perf_prefix']
+        if prefix:
+            # the whole command runs remotely, so its stderr (where perf writes) is redirected there
+            cmd = (prefix % socket.gethostname()).split() + [perfCmd + ' 2>&1']
+        else:
+            cmd = perfCmd.split()
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        threading.Thread(target=self.readLines, daemon=True).start()
+
+    # perf -I -x, prints a line per event per interval: timestamp,count,unit,event,...
+    # lines that cannot be parsed (headers, <not counted>, warnings) are skipped
+    def readLines(self):
+        counts = dict()
+        last = None
+        for line in self.proc.stdout:
+            ss = line.decode('utf-8', 'replace').strip().split(',')
+            if len(ss) < 4:
+                continue
+            try:
+                ts, count = float(ss[0]), float(ss[1])
+            except ValueError:
+                continue
+            # the event names may have commas too
+            rest = ','.join(ss[3:])
+            event = None
+            for e in self.events:
+                if rest == e or rest.startswith(e + ','):
+                    event = e
+            if event is None:
+                continue
+            if ts != last:
+                counts = dict()
+                last = ts
+            counts[event] = count
+            if len(counts) == len(self.events):
+                self.put({
+                    'instructions': counts[self.events[0]],
+                    'cycles': counts[self.events[1]],
+                    'membytes': sum([counts[e] for e in self.events[2:]]) * 64,
+                    'seconds': self.intervalMs / 1000,
+                })
+        self.put(None)
+
+    # the oldest interval makes room when the queue is full
+    def put(self, counts):
+        while True:
+            try:
+                self.intervals.put_nowait(counts)
+                return
+            except queue.Full:
+                try:
+                    self.intervals.get_nowait()
+                except queue.Empty:
+                    pass
+
+    # drop the intervals not read yet, they were measured before a CAT change
+    def sync(self):
+        try:
+            while True:
+                if self.intervals.get_nowait() is None:
+                    self.intervals.put(None)
+                    return
+        except queue.Empty:
+            pass
+
+    def read(self):
+        return self.intervals.get()
+
+    def setWays(self, w):
+        pass
+
+    def close(self):
+        if self.proc:
+            self.proc.terminate()
+
+# counts from a model of a job, to test without the hardware
+# ipc grows and membw drops with the ways: v(w) = v(full) * (1 +- sensitivity * exp(-w/knee))
+class SSSyntheticSource:
+    hardware = False
+    def __init__(self, params=None):
+        self.params = params if params else CFG.PROF['synthetic']
+        self.random = random.Random(self.params['seed'])
+        self.ways = CFG.CLUSTER['llcway_per_node']
+
+    def open(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def setWays(self, w):
+        self.ways = w
+
+    def read(self):
+        p = self.params
+        seconds = p['interval_s']
+        if seconds > 0:
+            time.sleep(seconds)
+        shape = math.exp(-self.ways / p['knee'])
+        ipc = p['ipc'] / (1 + p['sensitivity'] * shape)
+        membw = p['membw'] * (1 + p['sensitivity'] * shape)
+        noise = lambda: 1 + self.random.gauss(0, p['noise'])
+        cycles = 2.4e9 * max(seconds, 1e-3) * CFG.CLUSTER['core_per_node']
+        return {
+            'instructions': ipc * noise() * cycles,
+            'cycles': cycles,
+            'membytes': membw * noise() * 1e9 * max(seconds, 1e-3),
+            'seconds': max(seconds, 1e-3),
+        }
+
+    def close(self):
+        pass
+
+def makeSource():
+    if CFG.PROF['sampler'] == 'synthetic':
+        return SSSyntheticSource()
+    return SSPerfSource()
+
+'''
+The sampling schedules, nextWays() is the ways of the next window, None when sampling is done.
+'''
+# cycle over CFG.PROF['sample_ways'] for the whole job
+class SSFixedSchedule:
+    def __init__(self):
+        self.cnt = 0
+
+    def nextWays(self):
+        ways = CFG.PROF['sample_ways']
+        w = ways[self.cnt % len(ways)]
+        self.cnt += 1
+        return w
+
+    def add(self, w, ipc, mbw):
+        pass
+
+# student t 0.975 quantiles for 1 to 10 degrees of freedom, 1.96 beyond
+T975 = [12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23]
+
+# sample each point until the confidence intervals of its ipc and membw are tight enough,
+# then add points in the middle of the segments around a point where the curve bends,
+# and stop once all points converge and the curve is linear enough between them
+class SSAdaptiveSchedule:
+    def __init__(self):
+        self.params = CFG.PROF['adaptive']
+        # ways -> list of (ipc, membw)
+        self.samples = dict([(w, []) for w in CFG.PROF['sample_ways']])
+
+    def converged(self, w):
+        vals = self.samples[w]
+        n = len(vals)
+        if n >= self.params['max_samples']:
+            return True
+        if n < self.params['min_samples']:
+            return False
+        t = T975[n-2] if n-2 < len(T975) else 1.96
+        for k in range(2):
+            v = [val[k] for val in vals]
+            mean = sum(v) / n
+            std = math.sqrt(sum([(x-mean)**2 for x in v]) / (n-1))
+            if t * std / math.sqrt(n) > self.params['ci_rel'] * abs(mean):
+                return False
+        return True
+
+    def mean(self, w, k):
+        return sum([val[k] for val in self.samples[w]]) / len(self.samples[w])
+
+    # the middles of the segments around each point that is off the line of its neighbors
+    def bends(self):
+        points = sorted(self.samples)
+        extra = []
+        for i in range(1, len(points)-1):
+            lo, w, hi = points[i-1], points[i], points[i+1]
+            for k in range(2):
+                line = self.mean(lo, k) + (self.mean(hi, k) - self.mean(lo, k)) * (w - lo) / (hi - lo)
+                if abs(self.mean(w, k) - line) > self.params['bend_rel'] * abs(self.mean(w, k)):
+                    for a, b in [(lo, w), (w, hi)]:
+                        if b - a > 1 and (a+b)//2 not in extra:
+                            extra.append((a+b)//2)
+                    break
+        return [w for w in extra if w not in self.samples]
+
+    def nextWays(self):
+        todo = [w for w in self.samples if not self.converged(w)]
+        if len(todo) == 0:
+            for w in self.bends():
+                if len(self.samples) >= self.params['max_points']:
+                    break
+                self.samples[w] = []
+            todo = [w for w in self.samples if not self.converged(w)]
+            if len(todo) == 0:
+                return None
+        # the least sampled, more ways first
+        return min(todo, key=lambda w: (len(self.samples[w]), -w))
+
+    def add(self, w, ipc, mbw):
+        self.samples[w].append((ipc, mbw))
+
+def makeSchedule():
+    if CFG.PROF['schedule'] == 'adaptive':
+        return SSAdaptiveSchedule()
+    return SSFixedSchedule()
+
+'''
+SSSampler lives in the daemon, it opens the counters once and keeps them open.
+While some runner is attached, the profiled job is sampled with different ways as the schedule
+(CFG.PROF['schedule']) decides, and a (ways, ipc, membw) sample is pushed to all attached runners
+after each window. A window is CFG.PROF['sample_intervals'] intervals, after dropping the one the
+CAT changed in. Once the schedule is done, or without runners attached, the node is given back the
+full LLC, and the sampler waits for the next runner.
+The sampler only changes the CAT while no runner has applied a layout since its own last change,
+after the profiled job finishes the next job may already have been given its layout (see SSCat.applyIf).
+'''
+class SSSampler(threading.Thread):
+    def __init__(self, source=None):
+        super().__init__(daemon=True)
+        self.logger = SSLogger('Sampler')
+        self.source = source if source else makeSource()
+        # callables taking (ways, ipc, membw)
+        self.sinks = []
+        self.lock = threading.Lock()
+        self.attached = threading.Event()
+        self.detached = threading.Event()
+        self.detached.set()
+        self.stopped = False
+
+    def attach(self, sink):
+        with self.lock:
+            self.sinks.append(sink)
+            self.detached.clear()
+            self.attached.set()
+
+    def detach(self, sink):
+        with self.lock:
+            self.sinks.remove(sink)
+            if len(self.sinks) == 0:
+                self.attached.clear()
+                self.detached.set()
+
+    def stop(self):
+        self.stopped = True
+        self.attached.set()
+        self.detached.set()
+
+    # (ipc, membw) over a window, None if the source is closed
+    def window(self):
+        self.source.sync()
+        if self.source.read() is None: # partial, the CAT changed in it
+            return None
+        total = {'instructions': 0, 'cycles': 0, 'membytes': 0, 'seconds': 0}
+        for _ in range(CFG.PROF['sample_intervals']):
+            counts = self.source.read()
+            if counts is None:
+                return None
+            for k in total:
+                total[k] += counts[k]
+        return (total['instructions'] / total['cycles'], total['membytes'] * 1e-9 / total['seconds'])
+
+    def run(self):
+        self.source.open()
+        while not self.stopped:
+            self.attached.wait()
+            # a new schedule for the runners attached from now until all detach
+            schedule = makeSchedule()
+            # the layout of the profiled job, applied before it attached
+            version = getCatBackend().version
+            while not self.stopped and self.attached.is_set():
+                w = schedule.nextWays()
+                if w is None: # enough samples, run at full LLC until all detach
+                    self.logger.info('profile converged')
+                    version = set_cat(version=version)
+                    self.source.setWays(CFG.CLUSTER['llcway_per_node'])
+                    self.detached.wait()
+                    break
+                version = set_cat(w, flush=self.source.hardware, version=version)
+                if version is None: # the job has finished, and another layout is applied
+                    break
+                self.source.setWays(w)
+                sample = self.window()
+                if sample is None:
+                    self.logger.error('counter source closed')
+                    self.stopped = True
+                    break
+                schedule.add(w, sample[0], sample[1])
+                with self.lock:
+                    for sink in self.sinks:
+                        sink(w, sample[0], sample[1])
+            if version is not None:
+                set_cat(version=version)
+            self.source.setWays(CFG.CLUSTER['llcway_per_node'])
+        self.source.close()
+
+# the profiled job gets w ways on cores 0-15, the rest of the ways and cores form another COS
+# with a version (of SSCat), nothing is changed if another layout has been applied since
+# return the version of the layout, None if it is not applied
+def set_cat(w=CFG.CLUSTER['llcway_per_node'], flush=True, version=None):
+    nways = CFG.CLUSTER['llcway_per_node']
+    backend = getCatBackend()
+    apply = backend.apply if version is None else lambda layout: backend.applyIf(layout, version)
+    if w == nways:
+        return apply(dict())
+    mask = (1 << w) - 1
+    inv_mask = ((1 << (nways-w)) - 1) << w
+    version = apply({
+        1: (mask, tuple(range(0, 16))),
+        2: (inv_mask, tuple(range(16, CFG.CLUSTER['core_per_node']))),
+    })
+    if flush and version is not None:
         subprocess.run([CFG.RUN['deploy_path']+'llcflush.sh'], stdout=subprocess.DEVNULL)
+    return version
 
 #if __name__ == '__main__':
 #    #ws = [2,4,8,20,20,8,4,2]
@@ -54,9 +359,8 @@ def set_cat(w=CFG.CLUSTER['llcway_per_node']):
 #            if i >= 0:
 #                print('%d %d\t%.2f\t%.2f\t%.2f' % (w, i, ips, cps, mbw), flush=True)
 
+# print the samples, a line of 'ways ipc membw' each
 if __name__ == '__main__':
-    while True:
-        for w in CFG.PROF['sample_ways']:
-            set_cat(w)
-            ipc, mbw = get_value()
-            print('%d %.4f %.4f' % (w, ipc, mbw), flush=True)
+    sampler = SSSampler()
+    sampler.attach(lambda w, ipc, mbw: print('%d %.4f %.4f' % (w, ipc, mbw), flush=True))
+    sampler.run()
@@ -1,7 +1,12 @@
 import socket
+import asyncio
+import os
 import selectors
+import errno
 import types
 import json
+import struct
+from collections import deque
 from SSlogger import SSLogger
 from SSconfig import SSConfig as CFG
 
@@ -18,14 +23,24 @@ class SSNetwork:
         self.sel = selectors.DefaultSelector()
         # connections, clinet -> connection
         self.connections = dict()
-        # obj buffer for each connection, connection -> object list
-        # buf[0] is the tailing string (without a '#' end flag)
-        # buf[1] and after are completed commands
+        # obj buffer for each connection, connection -> SSFrameDecoder
         self.objectBuffer = dict()
+        # framing used to send to each destination, eoc (the default) or length, see SSFrameDecoder
+        self.framing = dict()
+        # bytes waiting to be sent on each connection, connection -> bytearray
+        # a connection with pending bytes is also registered for EVENT_WRITE, and flushed when writable
+        self.outbox = dict()
+        # bytes queued in all outboxes, and the destinations whose outbox is above the high watermark
+        self.outboxBytes = 0
+        self.congested = set()
+        # the pipe other threads write to to end a blocking recvObj, see addWakeup
+        self.wakeupPipe = None
         # constant values
         self.EOC = CFG.NET['eoc']
+        self.EOC_BYTES = self.EOC.encode('utf-8')
         self.CONNECTION_BROKEN = CFG.NET['broken_conn_str']
         self.NEW_CONNECTION = CFG.NET['new_conn_str']
+        self.WAKEUP = 'Wakeup'
         self.SS_MASTER = socket.gethostbyname(CFG.NET['master_hostname']) 
         self.SS_PORT = CFG.NET['master_port']
         self.BACK_LOG = CFG.NET['master_backlog']
@@ -37,7 +52,7 @@ class SSNetwork:
             lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # IPV4 and TCP
             lsock.bind(('', self.SS_PORT)) # accept from any
             lsock.listen(self.BACK_LOG)
-            # use selector for non blocking IO, only check READ, assume always writable
+            # use selector for non blocking IO, WRITE is checked only for connections with pending bytes
             lsock.setblocking(False)
             self.sel.register(lsock, selectors.EVENT_READ, data=self.NEW_CONNECTION) 
             self.logger.info('Master started on %s' % socket.gethostname())
@@ -49,17 +64,104 @@ class SSNetwork:
             #workerName = socket.gethostname()
             self.sel.register(sock, selectors.EVENT_READ, data='master')
             self.connections['master'] = sock # only connects to master
-            self.objectBuffer[sock] = ['']
+            self.objectBuffer[sock] = SSFrameDecoder()
+            self.outbox[sock] = bytearray()
             self.logger.info('Daemon started on %s' % socket.gethostname())
     
-    # send object to destination
+    # make wakeup() end a recvObj waiting in select, it can be called from any thread
+    def addWakeup(self):
+        if self.wakeupPipe:
+            return
+        rfd, wfd = os.pipe()
+        os.set_blocking(rfd, False)
+        os.set_blocking(wfd, False)
+        self.wakeupPipe = (rfd, wfd)
+        self.sel.register(rfd, selectors.EVENT_READ, data=self.WAKEUP)
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeupPipe[1], b'\0')
+        except BlockingIOError: # the pipe is full, recvObj will wake up anyway
+            pass
+
+    # the framing to send to destination, it should be agreed by both sides (see SSProtocol.greeting)
+    def setFraming(self, destination, framing):
+        self.framing[destination] = framing
+
     # 1. use json to serialize an object to string, only basic python types supported
-    # 2. append EOC to the string, so that object strings can be separated on remote
-    # 3. sendall, we dont send a string in multiple times. sendall is blocking but should work in our case
+    # 2. frame it, so that object strings can be separated on remote,
+    #    eoc: append EOC; length: prepend the magic byte and the length
+    def wrapObj(self, obj, framing):
+        data = json.dumps(obj).encode('utf-8')
+        if framing == 'length':
+            return struct.pack('!BI', CFG.NET['frame_magic'], len(data)) + data
+        else:
+            return data + self.EOC_BYTES
+
+    # send object to destination
+    # the bytes are queued and sent as far as the socket takes them, the rest is flushed by recvObj
+    # when the connection becomes writable, so a slow destination never blocks the caller
     def sendObjTo(self, destination, obj=None):
         #print('To Send >>', obj)
-        wrapMsg = json.dumps(obj) + self.EOC
-        self.connections[destination].sendall(wrapMsg.encode('utf-8'))
+        wrapMsg = self.wrapObj(obj, self.framing.get(destination, 'eoc'))
+        self.queueBytes(destination, wrapMsg)
+
+    # send a batch of objects to destination with one send
+    def sendObjsTo(self, destination, objs):
+        framing = self.framing.get(destination, 'eoc')
+        wrapMsg = b''.join([self.wrapObj(obj, framing) for obj in objs])
+        self.queueBytes(destination, wrapMsg)
+
+    # bytes queued for destination but not yet sent
+    def pendingBytes(self, destination):
+        conn = self.connections.get(destination)
+        return len(self.outbox.get(conn, b''))
+
+    def isCongested(self, destination):
+        return destination in self.congested
+
+    def queueBytes(self, destination, data):
+        conn = self.connections[destination]
+        if conn not in self.outbox: # broken connection, its outbox has been dropped
+            return
+        out = self.outbox[conn]
+        wasEmpty = len(out) == 0
+        out += data
+        self.outboxBytes += len(data)
+        if wasEmpty: # nothing in front of it, try to send right now
+            self.flush(destination, conn)
+            if conn not in self.outbox: # broken while sending
+                return
+            if len(out): # the socket is full, wait for it to become writable
+                self.sel.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, data=destination)
+        if len(out) > CFG.NET['outbox_high_water'] and destination not in self.congested:
+            self.congested.add(destination)
+            self.logger.info(destination, 'is congested, %d bytes queued' % len(out))
+
+    # send as much of the outbox of conn as the socket takes
+    def flush(self, destination, conn):
+        out = self.outbox[conn]
+        try:
+            sent = conn.send(out)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            if e.errno == errno.ENOTCONN: # a worker still connecting
+                sent = 0
+            else: # broken, the read side sees it as EOF
+                self.logger.info(destination, 'send failed:', e)
+                self.dropOutbox(destination, conn)
+                return
+        del out[:sent]
+        self.outboxBytes -= sent
+        if len(out) == 0:
+            self.congested.discard(destination)
+
+    def dropOutbox(self, destination, conn):
+        out = self.outbox.pop(conn, None)
+        if out is not None:
+            self.outboxBytes -= len(out)
+        self.congested.discard(destination)
 
     # recv an object from anywhere
     # return value: (source, object received)
@@ -70,19 +172,37 @@ class SSNetwork:
         # find someone has objects, and return the first pending object
         for client, conn in self.connections.items():
             buf = self.objectBuffer[conn]
-            if len(buf) >= 2:
-                obj = buf.pop(1)
+            if len(buf.objects):
+                obj = buf.objects.popleft()
                 if obj == self.CONNECTION_BROKEN: # all the objects from a broken have been received
                     self.logger.info(client, 'lost connection')
-                    assert(buf[0] == '') # there should be not tailing incomplete string
+                    assert(len(buf.data) == 0) # there should be not tailing incomplete object
                     self.objectBuffer.pop(conn) # remove the entry for broken connection
+                    self.dropOutbox(client, conn)
                     self.connections.pop(client) # also remove the connection
+                    self.framing.pop(client, None)
                 return (client, obj)
         sourcelist = []
         # check if something to read from socket
         events = self.sel.select(timeout=timeout)
         for key, mask in events:
-            assert(mask & selectors.EVENT_READ)
+            # pending bytes can be sent
+            if mask & selectors.EVENT_WRITE:
+                conn = key.fileobj
+                if conn in self.outbox:
+                    self.flush(key.data, conn)
+                if conn not in self.outbox or len(self.outbox[conn]) == 0:
+                    self.sel.modify(conn, selectors.EVENT_READ, data=key.data)
+            if not mask & selectors.EVENT_READ:
+                continue
+            # woken up by another thread, nothing to receive
+            if key.data is self.WAKEUP:
+                try:
+                    while os.read(key.fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
             # new connection, only master should receive this
             if key.data is self.NEW_CONNECTION:
                 assert(self.mode == 'master')
@@ -97,7 +217,8 @@ class SSNetwork:
                     print('Currently we dont handle this case')
                     assert(False)
                 self.connections[addr] = conn # record new connection
-                self.objectBuffer[conn] = ['']
+                self.objectBuffer[conn] = SSFrameDecoder()
+                self.outbox[conn] = bytearray()
                 # for new connection event, we don't need to receive data
             else:
                 sourcelist.append(key.data) # append a source that has data here, key.data is 'addr' of client
@@ -107,26 +228,159 @@ class SSNetwork:
             # entry should be added when connection built
             assert(conn in self.objectBuffer)
             buf = self.objectBuffer[conn]
-            # receive whatever it can
-            s = conn.recv(1024).decode('utf-8') # a string that may have <1, =1, >1 dumped objects
-            if len(s) == 0: # connection broken
+            # receive whatever it can, may have <1, =1, >1 framed objects
+            data = conn.recv(CFG.NET['recv_bufsize'])
+            if len(data) == 0: # connection broken
                 # NOTE !!! DO NOT pop connection from the buffer immediatly since it may have unread objects
                 # DON'T DO THIS: self.commandBuffer.pop(conn)
                 # However, the connection can be unregister
                 self.sel.unregister(conn)
+                # nothing more can be delivered
+                self.dropOutbox(source, conn)
                 # append the broken info to the object buffer
-                buf.append(self.CONNECTION_BROKEN)
-            else: # normal string
-                ss = s.split(self.EOC) # split by EOC, each slice is an object or a pice of an object
-                if len(ss) == 1: # incomplement
-                    buf[0] = buf[0] + ss[0] # still incomplete
-                else:
-                    buf.append(json.loads(buf[0]+ss[0])) # the incomplete buf[0] now completed, de-serialized
-                    for i in range(1, len(ss)-1): # middle slices must tbe completed
-                        buf.append(json.loads(ss[i]))
-                    buf[0] = ss[-1] # the tail may be incomplete
+                buf.objects.append(self.CONNECTION_BROKEN)
+            else: # normal data
+                buf.feed(data)
         return (None, None) # nothing
 
+'''
+SSFrameDecoder incrementally splits the bytes received from a connection into objects.
+Both framings are accepted, frame by frame, so a peer can switch framing at any time:
+  eoc: the json followed by EOC
+  length: the magic byte, 4-byte big-endian length, then the json
+The bytes are kept in one buffer and parsed in place, objects are de-serialized from bytes.
+'''
+class SSFrameDecoder:
+    def __init__(self):
+        # received bytes not yet parsed
+        self.data = bytearray()
+        # de-serialized objects, not yet taken
+        self.objects = deque()
+        self.EOC_BYTES = CFG.NET['eoc'].encode('utf-8')
+        self.MAGIC = CFG.NET['frame_magic']
+        # where to continue looking for EOC in data, so an incomplete object is not scanned again
+        self.eocFrom = 0
+
+    def feed(self, data):
+        self.data += data
+        pos = 0
+        end = len(self.data)
+        while pos < end:
+            if self.data[pos] == self.MAGIC: # length framing
+                if end - pos < 5:
+                    break
+                length = struct.unpack_from('!I', self.data, pos+1)[0]
+                if end - pos - 5 < length:
+                    break
+                self.objects.append(json.loads(self.data[pos+5:pos+5+length]))
+                pos += 5 + length
+            else: # eoc framing
+                eoc = self.data.find(self.EOC_BYTES, max(pos, self.eocFrom))
+                if eoc < 0:
+                    self.eocFrom = max(pos, end - len(self.EOC_BYTES) + 1)
+                    break
+                self.objects.append(json.loads(self.data[pos:eoc]))
+                pos = eoc + len(self.EOC_BYTES)
+        # drop the parsed bytes
+        del self.data[:pos]
+        self.eocFrom = max(0, self.eocFrom - pos)
+
+'''
+SSAsyncMasterNetwork is the master side of SSNetwork for an asyncio event loop.
+Each connection is served by an SSConnectionProtocol, objects are passed to onObject(client, obj) as they
+arrive, and CONNECTION_BROKEN is passed after all the objects of a lost connection.
+Sending has the same interface as SSNetwork, the transports keep what cannot be sent immediately.
+'''
+class SSAsyncMasterNetwork:
+    def __init__(self, onObject):
+        self.logger = SSLogger('Network', info=False, echo=False)
+        self.hostname = socket.gethostname()
+        self.mode = 'master'
+        self.onObject = onObject
+        # connections, client -> transport
+        self.connections = dict()
+        self.framing = dict()
+        # destinations whose transport is above the high watermark
+        self.congested = set()
+        self.server = None
+        self.closing = False
+        self.EOC = CFG.NET['eoc']
+        self.EOC_BYTES = self.EOC.encode('utf-8')
+        self.CONNECTION_BROKEN = CFG.NET['broken_conn_str']
+        self.SS_PORT = CFG.NET['master_port']
+        self.BACK_LOG = CFG.NET['master_backlog']
+        # listen right away as SSMasterNetwork does, connections are accepted once the loop serves
+        self.lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.lsock.bind(('', self.SS_PORT))
+        self.lsock.listen(self.BACK_LOG)
+        self.lsock.setblocking(False)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: SSConnectionProtocol(self), sock=self.lsock, backlog=self.BACK_LOG)
+        self.logger.info('Master started on %s' % self.hostname)
+
+    def close(self):
+        self.closing = True
+        if self.server:
+            self.server.close()
+        for transport in self.connections.values():
+            transport.close()
+
+    setFraming = SSNetwork.setFraming
+    wrapObj = SSNetwork.wrapObj
+
+    def sendObjTo(self, destination, obj=None):
+        self.write(destination, self.wrapObj(obj, self.framing.get(destination, 'eoc')))
+
+    def sendObjsTo(self, destination, objs):
+        framing = self.framing.get(destination, 'eoc')
+        self.write(destination, b''.join([self.wrapObj(obj, framing) for obj in objs]))
+
+    def write(self, destination, data):
+        transport = self.connections.get(destination)
+        if transport is None or transport.is_closing(): # lost, nothing can be delivered
+            return
+        transport.write(data)
+
+    def pendingBytes(self, destination):
+        transport = self.connections.get(destination)
+        return transport.get_write_buffer_size() if transport else 0
+
+    def isCongested(self, destination):
+        return destination in self.congested
+
+class SSConnectionProtocol(asyncio.Protocol):
+    def __init__(self, net):
+        self.net = net
+        self.decoder = SSFrameDecoder()
+        self.client = None
+
+    def connection_made(self, transport):
+        self.client = transport.get_extra_info('peername') # the same (ip, port) as accept
+        transport.set_write_buffer_limits(high=CFG.NET['outbox_high_water'])
+        self.net.connections[self.client] = transport
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        while len(self.decoder.objects):
+            self.net.onObject(self.client, self.decoder.objects.popleft())
+
+    def connection_lost(self, exc):
+        self.net.logger.info(self.client, 'lost connection')
+        self.net.connections.pop(self.client, None)
+        self.net.framing.pop(self.client, None)
+        self.net.congested.discard(self.client)
+        if not self.net.closing: # not closed by ourselves
+            self.net.onObject(self.client, self.net.CONNECTION_BROKEN)
+
+    def pause_writing(self):
+        self.net.congested.add(self.client)
+        self.net.logger.info(self.client, 'is congested')
+
+    def resume_writing(self):
+        self.net.congested.discard(self.client)
+
 class SSMasterNetwork(SSNetwork):
     def __init__(self):
         super().__init__(mode='master')
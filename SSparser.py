@@ -1,10 +1,12 @@
 #!/usr/bin/python3
 import json
+import os
 import sys
 import math
 import numpy as np
 from datetime import datetime
 from SSconfig import SSConfig as CFG
+from SShistory import openHistory, parseLine
 '''
 SSParser is used for the statistics and visualization of job records
 JOBID     0: 
@@ -31,24 +33,72 @@ class SSParser:
             if selfunc(r):
                 selRecs.append(r)
         return selRecs
-    # get records from file
+    # get records from file, both the compact records (see SShistory) and the full ones
     def loadFile(self, fname):
         recs = []
-        with open(fname, 'r') as fr:
-            lines = fr.readlines()
-            for line in lines:
-                job = json.loads(line[13:])
+        with openHistory(fname) as fr:
+            for line in fr:
+                if len(line.strip()) == 0:
+                    continue
+                jobid, job = parseLine(line)
                 rec = {
                     'name': job['jobattr']['jobname'],
-                    'jobid': job['allocation'][0][1]['jobid'],
+                    'jobid': jobid,
                     'submit': job['submitTime'],
                     'start': job['startTime'],
                     'finish': job['finishTime'],
-                    'nproc': job['allocation'][0][1]['jobattr']['parallelism'],
-                    'nodelist': job['nodelist']
+                    'nproc': job['jobattr']['parallelism'],
+                    'nodelist': job['nodelist'],
+                    'backfill': job.get('backfill', False)
                     }
                 recs.append(rec)
         return recs
+    # columnar form of records, sorted by jobid, for fast loading (see exportColumns)
+    # nodelist of the i-th job is nodes[node_offsets[i]:node_offsets[i+1]]
+    def columnsOf(self, recs):
+        recs = sorted(recs, key=lambda x: x['jobid'])
+        offsets = np.zeros(len(recs)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(rec['nodelist']) for rec in recs])
+        return {
+            'jobid': np.array([rec['jobid'] for rec in recs], dtype=np.int64),
+            'name': np.array([rec['name'] for rec in recs], dtype=str),
+            'submit': np.array([rec['submit'] for rec in recs], dtype=np.float64),
+            'start': np.array([rec['start'] for rec in recs], dtype=np.float64),
+            'finish': np.array([rec['finish'] for rec in recs], dtype=np.float64),
+            'nproc': np.array([rec['nproc'] for rec in recs], dtype=np.int64),
+            'backfill': np.array([rec.get('backfill', False) for rec in recs], dtype=bool),
+            'nodes': np.array([node for rec in recs for node in rec['nodelist']], dtype=str),
+            'node_offsets': offsets,
+        }
+    def exportColumns(self, recs, fname):
+        np.savez(fname, **self.columnsOf(recs))
+    def loadColumns(self, fname):
+        with np.load(fname) as data:
+            return dict([(k, data[k]) for k in data.files])
+    # the columns of a history file, from its .npz next to it, which is written if missing or older
+    def loadFileColumns(self, fname):
+        npzname = fname + '.npz'
+        if os.path.exists(npzname) and os.path.getmtime(npzname) >= os.path.getmtime(fname):
+            return self.loadColumns(npzname)
+        cols = self.columnsOf(self.loadFile(fname))
+        np.savez(npzname, **cols)
+        return cols
+    # records of columns, e.g. for getBasicStats
+    def recordsOf(self, cols):
+        recs = []
+        offsets = cols['node_offsets']
+        for i in range(len(cols['jobid'])):
+            recs.append({
+                'name': str(cols['name'][i]),
+                'jobid': int(cols['jobid'][i]),
+                'submit': float(cols['submit'][i]),
+                'start': float(cols['start'][i]),
+                'finish': float(cols['finish'][i]),
+                'nproc': int(cols['nproc'][i]),
+                'nodelist': cols['nodes'][offsets[i]:offsets[i+1]].tolist(),
+                'backfill': bool(cols['backfill'][i]),
+                })
+        return recs
     # get records directly from database
     def loadHistory(self, history):
         recs = []
@@ -61,7 +111,8 @@ class SSParser:
                 'start': job['startTime'],
                 'finish': job['finishTime'],
                 'nproc': job['allocation'][0][1]['jobattr']['parallelism'],
-                'nodelist': job['nodelist']
+                'nodelist': job['nodelist'],
+                'backfill': job.get('backfill', False)
                 }
             recs.append(rec)
         return recs
@@ -77,6 +128,7 @@ class SSParser:
     # 3. bubble core hour, the idle core hours inside, exclude the tailing idle cores for CS/SS.
     # 4. job run time, wall time for each individual job
     # 5. job wait time, wait time for each individual job
+    # and how many jobs are started by backfilling
 
     def getBasicStats(self, recs):
         def mergeRanges(a):
@@ -126,7 +178,8 @@ class SSParser:
             
         return {'max_turnaround': max_turnaround, 'occupation': occupation*100,
                 'use_corehours': use_corehours, 'bubble_corehours': CFG.CLUSTER['core_per_node']*total_nodehours - use_corehours,
-                'jobwaittimes': jobwaittimes, 'jobruntimes': jobruntimes }
+                'jobwaittimes': jobwaittimes, 'jobruntimes': jobruntimes,
+                'backfilled_jobs': len([rec for rec in recs if rec.get('backfill', False)]) }
 
     def showSchedFig(self, recs):
         import numpy as np
@@ -229,16 +282,16 @@ if __name__ == '__main__':
                     continue
                 latest_hisf = max(jsf[js][alg])
                 parser = SSParser()
+                # sorted by jobid, cached in a .npz next to the history file
                 if latest_hisf.startswith('JobLogs'):
-                    parser.addRecords(parser.loadFile(latest_hisf))
+                    cols = parser.loadFileColumns(latest_hisf)
                 else:
-                    parser.addRecords(parser.loadFile('JobLogs/' + latest_hisf))
-                recs = sorted(parser.records, key=lambda x: x['jobid'])
-                waits = [x['start'] - x['submit'] for x in recs]
-                runs = [x['finish'] - x['start'] for x in recs]
+                    cols = parser.loadFileColumns('JobLogs/' + latest_hisf)
+                waits = cols['start'] - cols['submit']
+                runs = cols['finish'] - cols['start']
                 if min(runs) < 20: # An error occurs and the job fails
                     bad_jss.append(js)
-                jsf[js][alg] = {'wait': np.array(waits), 'run': np.array(runs)}
+                jsf[js][alg] = {'wait': waits, 'run': runs}
                 #print(alg, jsf[js][alg])
                 #print(jsf[js])
             if len(jsf[js]['CE']) != len(jsf[js]['CS']) or len(jsf[js]['CS']) != len(jsf[js]['SS']):
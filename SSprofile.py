@@ -0,0 +1,154 @@
+import os
+import json
+import sqlite3
+import numpy as np
+from SSconfig import SSConfig as CFG
+
+'''
+Profile curves as NumPy arrays.
+A curve is an array of shape (ways+1, 2), curve[w] = (ipc, membw) with w ways, NaN if unknown.
+The profile of a job from several daemons is an array of shape (daemons, ways+1, 2).
+Outside, in the returns of the daemons and in the profile store, curves are lists with -1 for unknown.
+'''
+IPC = 0
+MBW = 1
+
+def emptyCurve():
+    return np.full((CFG.CLUSTER['llcway_per_node'] + 1, 2), np.nan)
+
+# the average of the (ways, ipc, membw) samples for each ways
+def curveOfSamples(samples):
+    curve = emptyCurve()
+    if len(samples) == 0:
+        return curve
+    arr = np.asarray(samples, dtype=float)
+    ways = arr[:, 0].astype(int)
+    cnt = np.bincount(ways, minlength=len(curve))
+    for k in (IPC, MBW):
+        total = np.bincount(ways, weights=arr[:, 1+k], minlength=len(curve))
+        curve[cnt > 0, k] = total[cnt > 0] / cnt[cnt > 0]
+    return curve
+
+# linear interpolation between the known ways, ways outside them stay unknown
+def interpolate(curve):
+    known = np.flatnonzero(~np.isnan(curve[:, IPC]))
+    if len(known) < 2:
+        return curve
+    ways = np.arange(known[0], known[-1] + 1)
+    out = curve.copy()
+    for k in (IPC, MBW):
+        out[ways, k] = np.interp(ways, known, curve[known, k])
+    return out
+
+# the curves in the returns of all daemons, as (daemons, ways+1, 2)
+# a way is unknown for a daemon unless both its ipc and membw are positive
+def stackReturns(returns):
+    rets = [ret for ret in returns if 'ipcs' in ret]
+    arr = np.full((len(rets), CFG.CLUSTER['llcway_per_node'] + 1, 2), np.nan)
+    for i, ret in enumerate(rets):
+        arr[i, :, IPC] = ret['ipcs']
+        arr[i, :, MBW] = ret['mbws']
+    valid = (arr[:, :, IPC] > 0) & (arr[:, :, MBW] > 0)
+    arr[~valid] = np.nan
+    return arr
+
+# the average over daemons, truncated to 4 digits
+def aggregate(profiles):
+    cnt = np.sum(~np.isnan(profiles[:, :, IPC]), axis=0)
+    total = np.nansum(profiles, axis=0)
+    curve = emptyCurve()
+    curve[cnt > 0] = total[cnt > 0] / cnt[cnt > 0, None]
+    return np.trunc(10000 * curve) / 10000
+
+def toLists(curve):
+    out = np.where(np.isnan(curve), -1, curve)
+    return (out[:, IPC].tolist(), out[:, MBW].tolist())
+
+'''
+SSProfileStore keeps the profiles in SQLite, one row per (prog, scale), the value as json.
+Adding a profile is one atomic insert, and the first profile of a (prog, scale) is kept.
+The text file (a json line {'prog', 'scale', 'value'} each) is imported whenever it changes,
+a later line replaces an earlier one as when the text file was loaded directly.
+The keys imported from the text file are kept in text_keys, an import replaces all of them, so a profile
+deleted from the text file is deleted from the store, and the profiles added by runs are kept.
+A path of ':memory:' keeps the store in memory, a copy of the store at copyFrom (opened read-only, so
+the profiles learned by runs are there too) if it exists, and the text file is imported into it.
+'''
+class SSProfileStore:
+    def __init__(self, path=None, textFilename=None, copyFrom=None):
+        self.path = path if path else CFG.DB['profile_store']
+        self.textFilename = textFilename if textFilename else CFG.DB['profile_fname']
+        # several simulations may share the store
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        if copyFrom and os.path.exists(copyFrom):
+            src = sqlite3.connect('file:%s?mode=ro' % copyFrom, uri=True, timeout=30)
+            try:
+                src.backup(self.conn)
+            finally:
+                src.close()
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS profiles (prog TEXT, scale, value TEXT, PRIMARY KEY (prog, scale)) WITHOUT ROWID')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            if self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'text_keys'").fetchone() is None:
+                # a store from before text_keys, import the text file again to fill it
+                self.conn.execute('CREATE TABLE text_keys (prog TEXT, scale, PRIMARY KEY (prog, scale)) WITHOUT ROWID')
+                self.conn.execute("DELETE FROM meta WHERE key = 'text_mtime'")
+        self.importText()
+
+    def importText(self):
+        if not os.path.exists(self.textFilename):
+            return 0
+        mtime = os.path.getmtime(self.textFilename)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'text_mtime'").fetchone()
+        if row and row[0] == mtime:
+            return 0
+        rows = []
+        with open(self.textFilename, 'r') as fr:
+            for line in fr:
+                if len(line.strip()) == 0:
+                    continue
+                kv = json.loads(line)
+                rows.append((kv['prog'], kv['scale'], json.dumps(kv['value'])))
+        with self.conn: # one transaction
+            self.conn.execute('DELETE FROM profiles WHERE (prog, scale) IN (SELECT prog, scale FROM text_keys)')
+            self.conn.execute('DELETE FROM text_keys')
+            self.conn.executemany('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?)', rows)
+            self.conn.executemany('INSERT OR IGNORE INTO text_keys VALUES (?, ?)', [row[:2] for row in rows])
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('text_mtime', ?)", (mtime,))
+        return len(rows)
+
+    # prog -> {scale -> value}
+    def load(self):
+        profiles = dict()
+        for prog, scale, value in self.conn.execute('SELECT prog, scale, value FROM profiles'):
+            if prog not in profiles:
+                profiles[prog] = dict()
+            profiles[prog][scale] = json.loads(value)
+        return profiles
+
+    # return False if (prog, scale) is already there
+    def add(self, prog, scale, value):
+        with self.conn:
+            cur = self.conn.execute('INSERT OR IGNORE INTO profiles VALUES (?, ?, ?)', (prog, scale, json.dumps(value)))
+        return cur.rowcount > 0
+
+    # forget a profile, so that the program is profiled again, all its scales if scale is None
+    def remove(self, prog, scale=None):
+        with self.conn:
+            # a profile of a run may take its place, it is not from the text file anymore
+            if scale is None:
+                self.conn.execute('DELETE FROM profiles WHERE prog = ?', (prog,))
+                self.conn.execute('DELETE FROM text_keys WHERE prog = ?', (prog,))
+            else:
+                self.conn.execute('DELETE FROM profiles WHERE prog = ? AND scale = ?', (prog, scale))
+                self.conn.execute('DELETE FROM text_keys WHERE prog = ? AND scale = ?', (prog, scale))
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM profiles').fetchone()[0]
+
+    # give back the space of replaced rows
+    def compact(self):
+        self.conn.execute('VACUUM')
+
+    def close(self):
+        self.conn.close()
@@ -4,7 +4,9 @@ Packing and unpacking data should be done through calling SSprotocal APIs,
 for the consistency between master and worker, especially for futrue modification
 '''
 class SSProtocol:
-    def __init__(self, version='1.0'):
+    # 1.0, objects are separated by EOC
+    # 2.0, greeting tells the framing, see greeting
+    def __init__(self, version='2.0'):
         self.version = version
         self.HEAD_GREETING = 'Greeting'
         self.HEAD_JOBFINISH = 'JobFinish'
@@ -16,10 +18,15 @@ class SSProtocol:
     # a greting message send to master when connected
     # role: daemon/master/user
     # hostname: hostname
-    def greeting(self, role, hostname):
-        return {'head': self.HEAD_GREETING, 'role': role, 'hostname': hostname}
+    # framing: the framing the sender supports, eoc or length (see SSNetwork)
+    # if a client asks for length, the master greets back with the framing they both use from then on,
+    # a 1.0 client does not ask, and a 1.0 master does not greet back, so both stay with eoc
+    def greeting(self, role, hostname, framing='eoc'):
+        return {'head': self.HEAD_GREETING, 'role': role, 'hostname': hostname, 'version': self.version, 'framing': framing}
     def isgreeting(self, msg):
         return msg['head'] == self.HEAD_GREETING
+    def framingof(self, msg):
+        return msg.get('framing', 'eoc')
     
     # daemon tells master it finishes a job
     # jobid: an integer identifier of a job
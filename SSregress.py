@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import hashlib
+import platform
+import argparse
+import numpy as np
+from SSconfig import SSConfig as CFG
+CFG.LOG['info'] = False
+from SSdatabase import SSDatabase
+from SSsimulator import SSSimulator, readTrace
+
+'''
+SSregress replays a few pinned traces through the algorithms and compares the scheduling quality
+(from SSParser.getBasicStats) and the simulator wall time with a baseline file.
+  ./SSregress.py --update     run and write the baseline
+  ./SSregress.py              run and compare, exit with 1 if a metric is worse than its tolerance
+The results depend on the profiles, run it where progs_profile.txt is, the md5 of the profiles the
+simulations loaded is kept in the baseline.
+A case whose trace file is missing (the Trinity slice needs trinity_trace.txt) is skipped, it fails the
+comparison only if it is given in --cases, as does a run that is not in the baseline.
+'''
+# name -> how to build the trace and the cluster
+# bw/hc: the bw-28 (8) and hc-28 (5) mix of SSsimulator, submitted every itvl seconds, durations from the profiles
+CASES = {
+    'bwhc-burst': {'kind': 'bwhc', 'jobs': 2000, 'itvl': 0, 'nodes': 100, 'seed': 1},
+    'bwhc-itvl10': {'kind': 'bwhc', 'jobs': 2000, 'itvl': 10, 'nodes': 100, 'seed': 2},
+    'trinity-2k': {'kind': 'file', 'fname': 'trinity_trace.txt', 'jobs': 2000, 'submitDiv': 4, 'nodes': 9408},
+}
+# metric -> (higher is better, relative tolerance, absolute tolerance)
+# a metric is worse or better only if it changes more than both, the wall time of short runs is noisy
+TOLERANCES = {
+    'occupation': (True, 0.01, 0),
+    'max_turnaround': (False, 0.02, 0),
+    'bubble_corehours': (False, 0.02, 0),
+    'job_wait': (False, 0.02, 1),
+    'job_run': (False, 0.02, 1),
+    'wall': (False, 0.25, 0.2),
+}
+METRICS = ['occupation', 'max_turnaround', 'bubble_corehours', 'job_wait', 'job_run', 'wall']
+
+def bwhcTrace(jobs, itvl, seed):
+    progs = ['bw-28']*8 + ['hc-28']*5
+    names = np.random.default_rng(seed).choice(progs, jobs).tolist()
+    return [(name, int(name[-2:]), float(i*itvl), 0.0) for i, name in enumerate(names)]
+
+# the trace of a case, None if its file is missing
+def caseTrace(case):
+    if case['kind'] == 'bwhc':
+        return bwhcTrace(case['jobs'], case['itvl'], case['seed'])
+    if not os.path.exists(case['fname']):
+        return None
+    return readTrace(case['fname'], limit=case['jobs'], submitDiv=case['submitDiv'])
+
+# the metrics of a simulation, the wall time is the best of repeat runs
+def runCase(alg, trace, nodes, backfill, repeat):
+    wall = None
+    for _ in range(repeat):
+        st = time.perf_counter()
+        sim = SSSimulator(alg=alg, backfill=backfill)
+        sim.addTrace(trace)
+        sim.addFakeDeamons('sn', nodes)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w') # the progress of the simulator
+        try:
+            sim.run(alpha=0.9)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        bs = sim.parse()
+        elapsed = time.perf_counter() - st
+        wall = elapsed if wall is None else min(wall, elapsed)
+        profiles = profileDigest(sim.db.progToProfile)
+        sim.db.close()
+    jobcnt = len(sim.parser.records)
+    return {
+        'occupation': bs['occupation'],
+        'max_turnaround': bs['max_turnaround'],
+        'bubble_corehours': bs['bubble_corehours'],
+        'job_wait': sum(bs['jobwaittimes'])/jobcnt,
+        'job_run': sum(bs['jobruntimes'])/jobcnt,
+        'jobs': jobcnt,
+        'backfilled_jobs': bs['backfilled_jobs'],
+        'wall': wall,
+        'profiles': profiles,
+    }
+
+# (status, relative change) of a metric, status is ok/better/worse
+def compare(metric, base, cur):
+    higher, tol, absTol = TOLERANCES[metric]
+    if base == 0:
+        change = 0 if cur == 0 else float('inf') * (1 if cur > 0 else -1)
+    else:
+        change = (cur - base) / abs(base)
+    gain = change if higher else -change
+    if abs(cur - base) <= absTol:
+        return ('ok', change)
+    if gain < -tol:
+        return ('worse', change)
+    if gain > tol:
+        return ('better', change)
+    return ('ok', change)
+
+# the md5 of the profiles a simulation used
+def profileDigest(progToProfile):
+    return hashlib.md5(json.dumps(progToProfile, sort_keys=True).encode('utf-8')).hexdigest()
+
+# the number of profiles the simulations load
+def profileCount():
+    db = SSDatabase(algorithm='CE', logToFile=False, profileStore=CFG.DB['sim_profile_store'])
+    cnt = len(db.progToProfile)
+    db.close()
+    return cnt
+
+def parseArgs():
+    ap = argparse.ArgumentParser(description='Compare the scheduling quality and simulation time with a baseline.')
+    ap.add_argument('--baseline', default='SSregress_baseline.json')
+    ap.add_argument('--update', action='store_true', help='write the results as the baseline')
+    ap.add_argument('--cases', nargs='+', default=None, choices=list(CASES.keys()), help='all by default, skipped cases do not fail then')
+    ap.add_argument('--algs', nargs='+', default=['CE', 'CS', 'SS'])
+    ap.add_argument('--backfill', default='none', help='none/easy, the trace durations are the walltimes of easy backfilling')
+    ap.add_argument('--repeat', type=int, default=1, help='the wall time is the best of this number of runs')
+    ap.add_argument('--no-time', action='store_true', help='do not fail on the wall time')
+    ap.add_argument('--out', default=None, help='also write the results as json')
+    return ap.parse_args()
+
+if __name__ == '__main__':
+    args = parseArgs()
+    if profileCount() == 0:
+        print('No profiles in %s or %s, run it where the profiles are' % (CFG.DB['profile_fname'], CFG.DB['profile_store']), file=sys.stderr)
+        sys.exit(2)
+    results = dict()
+    skipped = []
+    for name in (args.cases if args.cases else CASES):
+        case = CASES[name]
+        trace = caseTrace(case)
+        if trace is None:
+            print('Skip %s, %s not found' % (name, case['fname']), file=sys.stderr)
+            skipped.append(name)
+            continue
+        for alg in args.algs:
+            key = '%s/%s/%s' % (name, alg, args.backfill)
+            results[key] = runCase(alg, trace, case['nodes'], args.backfill, args.repeat)
+            print('%-30s done in %.2fs' % (key, results[key]['wall']), file=sys.stderr, flush=True)
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeat': args.repeat,
+            'profiles': sorted(set([r['profiles'] for r in results.values()]))}
+    if args.out:
+        with open(args.out, 'w') as fw:
+            json.dump({'meta': meta, 'results': results}, fw, indent=1)
+
+    if args.update:
+        baseline = {'meta': meta, 'results': dict()}
+        # other cases and backfill modes of the baseline are kept
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as fr:
+                baseline['results'] = json.load(fr)['results']
+        baseline['results'].update(results)
+        with open(args.baseline, 'w') as fw:
+            json.dump(baseline, fw, indent=1, sort_keys=True)
+        print('Baseline of %d runs written to %s' % (len(results), args.baseline))
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print('No baseline %s, run with --update first' % args.baseline)
+        sys.exit(2)
+    with open(args.baseline, 'r') as fr:
+        baseline = json.load(fr)
+    failed = 0
+    missing = len(skipped) if args.cases else 0
+    compared = 0
+    print('%-30s\t%16s\t%12s\t%12s\t%8s\t%6s' % ('RUN', 'METRIC', 'BASELINE', 'CURRENT', 'CHANGE', 'STATUS'))
+    for name in skipped:
+        print('%-30s\tskipped, no trace' % name)
+    for key, cur in results.items():
+        if key not in baseline['results']:
+            print('%-30s\tnot in the baseline' % key)
+            missing += 1
+            continue
+        base = baseline['results'][key]
+        if base.get('profiles') != cur['profiles']:
+            print('%-30s\tWarning: the profiles differ from those of the baseline, the quality metrics are not comparable' % key)
+        compared += 1
+        for metric in METRICS:
+            status, change = compare(metric, base[metric], cur[metric])
+            if status == 'worse' and not (metric == 'wall' and args.no_time):
+                failed += 1
+            print('%-30s\t%16s\t%12.3f\t%12.3f\t%+7.1f%%\t%6s' % (key, metric, base[metric], cur[metric], 100*change, status))
+    print('%d runs compared, %d metrics worse than the baseline, %d runs not compared' % (compared, failed, missing))
+    sys.exit(1 if failed or missing or compared == 0 else 0)
@@ -6,7 +6,8 @@ from SSconfig import SSConfig as CFG
 SSScheduler implements the scheduling algorithm
 '''
 class SSScheduler:
-    def __init__(self, algoname, database):
+    # backfill: none, no backfilling; easy, EASY backfilling
+    def __init__(self, algoname, database, backfill='none'):
         self.logger = SSLogger('Scheduler')
         if algoname == 'CE':
             self.algo = SSCEAlgorithm()
@@ -16,8 +17,20 @@ class SSScheduler:
             self.algo = SSSSAlgorithm()
         else:
             self.logger.error('No such algorithm, use CE/CS/SS.')
+        if backfill not in CFG.SCHED['backfill_modes']:
+            self.logger.error('No such backfill mode, use %s.' % '/'.join(CFG.SCHED['backfill_modes']))
+        self.backfill = backfill
         self.db = database
-        self.logger.succ('Algorithm %s used for resource allocation' % self.algo.name)
+        # jobid -> the cluster capacity version when the job failed to be allocated
+        # with the same capacity, the same job still cannot be allocated
+        self.stuckVersion = dict()
+        # backfilling, jobid -> (capacity version, most prior job) when the job failed to be backfilled
+        self.refusedVersion = dict()
+        # (capacity version, most prior job, reservation) of the last reservation
+        self.reservation = None
+        # (capacity version, most prior job, submitted jobs) when no job can be backfilled
+        self.backfillDone = None
+        self.logger.succ('Algorithm %s used for resource allocation, backfill: %s' % (self.algo.name, backfill))
 
     # the algorithm happens here
     # return a dictionary: daemon -> jobspec, and the estimation wall time
@@ -25,32 +38,126 @@ class SSScheduler:
         # no node or no job, cannot schedule
         if len(self.db.pendingJobs) and len(self.db.cluster.nodes):
             jobid = self.db.mostPriorJob()
-            # (parallelism, alpha, dict(scale->{time, ipcs, mbws}))
-            profile = self.db.getProfile(jobid) 
-            # the scheduling algorithm decides the order to try different scales
-            # or may only try part of them (CE only tries 1x, E)
-            # data structure of candidate is the same with profile
-            candidates = self.algo.sortCandidates(profile)
-            # self.logger.echo(candidates)
-            # try to allocate for each scale, if success, break
             allocation, est = None, None
-            for parallelism, scale, mode, alpha, ipcs, mbws, toprofile in candidates:
-                N, C, W, B = self.algo.calculateResourceDemand(parallelism, scale, mode, alpha, ipcs, mbws)
-                if N <= 0: # N<=0 means not feasible
-                    continue
-                # resource allocation, if not available (None)
-                # allocation is a dict, daemon -> jobspec (see Protocol)
-                allocation = self.db.allocateFor(jobid, N, C, W, B, scale, mode, toprofile) 
+            # nothing has changed since it failed, do not retry
+            if self.stuckVersion.get(jobid, None) != self.db.cluster.version:
+                allocation, est = self.tryAllocate(jobid)
                 if allocation:
-                    #self.logger.echo(candidates)
-                    est = self.algo.estimate(profile, scale, W)
-                    self.db.jobStart(jobid, est)
-                    break
-            if not allocation:
-                self.db.jobStuck(jobid)
+                    self.startJob(jobid, est)
+                else:
+                    self.db.jobStuck(jobid)
+                    self.stuckVersion[jobid] = self.db.cluster.version
+            if not allocation and self.backfill == 'easy':
+                allocation, est = self.backfillJob(jobid)
             return (allocation, est)
         return (None, None)
 
+    # start an allocated job, it is no longer stuck nor refused, whichever way it starts
+    def startJob(self, jobid, est, backfill=False):
+        self.db.jobStart(jobid, est, backfill=backfill)
+        self.stuckVersion.pop(jobid, None)
+        self.refusedVersion.pop(jobid, None)
+
+    # keep starting jobs until no more job can be started
+    # return a list of (allocation, est), see nextJob
+    def scheduleRound(self):
+        started = []
+        while True:
+            allocation, est = self.nextJob()
+            if not allocation:
+                break
+            started.append((allocation, est))
+        return started
+
+    # the resource demands of a job, in the order the algorithm tries them
+    # return a list of (N, C, W, B, scale, mode, toprofile)
+    def demandsOf(self, profile):
+        # the scheduling algorithm decides the order to try different scales
+        # or may only try part of them (CE only tries 1x, E)
+        # data structure of candidate is the same with profile
+        candidates = self.algo.sortCandidates(profile)
+        # self.logger.echo(candidates)
+        demands = []
+        for parallelism, scale, mode, alpha, ipcs, mbws, toprofile in candidates:
+            N, C, W, B = self.algo.calculateResourceDemand(parallelism, scale, mode, alpha, ipcs, mbws)
+            if N <= 0: # N<=0 means not feasible
+                continue
+            demands.append((N, C, W, B, scale, mode, toprofile))
+        return demands
+
+    # try to allocate for each scale, the first success is used
+    # accept(jobid, est) decides whether an allocation can be used, all are used if None
+    # return (allocation, est), the job is not started yet
+    def tryAllocate(self, jobid, accept=None):
+        # (parallelism, alpha, dict(scale->{time, ipcs, mbws}))
+        profile = self.db.getProfile(jobid) 
+        for N, C, W, B, scale, mode, toprofile in self.demandsOf(profile):
+            # resource allocation, if not available (None)
+            # allocation is a dict, daemon -> jobspec (see Protocol)
+            allocation = self.db.allocateFor(jobid, N, C, W, B, scale, mode, toprofile) 
+            if allocation:
+                #self.logger.echo(candidates)
+                est = self.db.userEstimate(jobid, self.algo.estimate(profile, scale, W))
+                if accept is None or accept(jobid, est):
+                    return (allocation, est)
+                self.db.allocationCancel(jobid)
+        return (None, None)
+
+    # EASY backfilling
+    # the most prior job (head) reserves the earliest time it can start (shadow time),
+    # a later job can start now if it finishes before the shadow time (by estimation),
+    # or if it leaves enough nodes for the head at the shadow time
+    def backfillJob(self, head):
+        version = self.db.cluster.version
+        # nothing has changed since no job could be backfilled
+        if self.backfillDone == (version, head, self.db.jobid):
+            return (None, None)
+        for jobid in self.db.priorJobs(CFG.SCHED['backfill_depth']):
+            if jobid == head or self.refusedVersion.get(jobid, None) == (version, head):
+                continue
+            reservation = self.reserveFor(head)
+            if not reservation: # cannot tell when the head starts, do not delay it
+                break
+            allocation, est = self.tryAllocate(jobid, lambda x, est: self.keepsReservation(x, est, reservation))
+            if allocation:
+                self.startJob(jobid, est, backfill=True)
+                return (allocation, est)
+            self.refusedVersion[jobid] = (version, head)
+        self.backfillDone = (version, head, self.db.jobid)
+        return (None, None)
+
+    # the reservation of a job, with its first feasible demand
+    # return (shadow time, extra nodes, projected node capacity, per node requirement), or None
+    def reserveFor(self, jobid):
+        version = self.db.cluster.version
+        if self.reservation and self.reservation[0:2] == (version, jobid):
+            return self.reservation[2]
+        reservation = None
+        for N, C, W, B, scale, _, _ in self.demandsOf(self.db.getProfile(jobid)):
+            if not self.db.allocatable(jobid, N, scale):
+                continue
+            perNodeReq = {'C':C, 'W':W, 'B':B}
+            r = self.db.reserve(N, perNodeReq)
+            if r:
+                reservation = r + (perNodeReq,)
+            break
+        self.reservation = (version, jobid, reservation)
+        return reservation
+
+    # whether the allocation for a job keeps the reservation of the head
+    def keepsReservation(self, jobid, est, reservation):
+        shadow, extra, projected, req = reservation
+        est = self.db.refinedEstimate(jobid, est)
+        if est is not None and self.db.getTimestampNow() + est <= shadow:
+            return True
+        # nodes that can be used by the head at the shadow time, but no longer can with this job
+        lost = 0
+        for daemon, nodeAlloc, _ in self.db.jobidToResource[jobid]:
+            key = projected.get(daemon, self.db.cluster.nodes[daemon]['capacity'])
+            if self.db.cluster.capacitySatisfy(key, req) and not self.db.cluster.capacitySatisfy(self.db.cluster.capacityAfter(key, nodeAlloc, -1), req):
+                lost += 1
+        return lost <= extra
+
 '''
 The algorithm to decide resource allocation for jobs
 All algorithms are implemented for bic cluster, some parameters are hard code
@@ -178,7 +285,8 @@ class SSSSAlgorithm(SSBaseAlgorithm):
     # return the estimation runtime according to profile
     def estimate(self, profile, scale, W):
         _, _, ps = profile
-        if not ps or scale not in ps:
+        # the ratio is against scale 1
+        if not ps or scale not in ps or 1 not in ps:
             return None
         else:
             ipcs = ps[scale]['ipcs']
@@ -1,13 +1,17 @@
 #!/usr/bin/python3
+import sys
 import time
+import math
 import numpy as np
 import heapq
+import itertools
 from datetime import datetime
 from SSdatabase import SSDatabase 
 from SSscheduler import SSScheduler
 from SSlogger import SSLogger
 from SSparser import SSParser
 from SSconfig import SSConfig as CFG
+from SStrace import loadTrace, tuplesOf
 import SSjobgenerator
 
 class SimulationClock:
@@ -21,21 +25,27 @@ class SimulationClock:
         return self.ts
 
 class SSSimulator:
-    def __init__(self, alg='CE'):
+    def __init__(self, alg='CE', backfill='none', profileStore=None):
         self.MIN_DAEMONS = 1
         self.clock = SimulationClock()
-        self.db = SSDatabase(algorithm=alg, simulationClock=self.clock, logToFile=False)
-        self.sched = SSScheduler(algoname=alg, database=self.db)
+        self.db = SSDatabase(algorithm=alg, simulationClock=self.clock, logToFile=False,
+            profileStore=profileStore if profileStore else CFG.DB['sim_profile_store'])
+        self.sched = SSScheduler(algoname=alg, database=self.db, backfill=backfill)
         self.logger = SSLogger('Simulator')
         self.parser = SSParser()
         self.users = []
         self.daemons = []
         self.trace = []
+        self.stream = None
         self.pendingJobs = dict()
         self.runningJobs = dict()
+        # kinds of simulation events
+        self.EVENT_FINISH = 0
+        self.EVENT_SUBMIT = 1
+        self.EVENT_RETRY = 2
     
     def isclean(self):
-        if len(self.db.pendingJobs) or len(self.db.runningJobs) or len(self.trace):
+        if len(self.db.pendingJobs) or len(self.db.runningJobs) or len(self.trace) or self.stream is not None:
             return False
         else:
             return True
@@ -44,11 +54,13 @@ class SSSimulator:
         self.trace.extend(trace)
         self.trace.sort(key=lambda x: x[2])
 
+    # a stream of jobs in submit time order (e.g. SStrace.streamTrace or iterArray), replayed by run
+    # without holding the trace, only one stream, after the jobs added by addTrace
+    def addStream(self, stream):
+        self.stream = stream
+
     def loadTrace(self, fname):
-        with open(fname, 'r') as fr:
-            for line in fr.readlines():
-                program, nproc, submittime, duration = line.strip().split(',')
-                self.trace.append((program, int(nproc), float(submittime), float(duration)))
+        self.trace.extend(tuplesOf(loadTrace(fname)))
         self.trace.sort(key=lambda x: x[2])
         jobs = ', '.join([x[0] for x in self.trace])
         self.logger.info('Job trace: ', jobs)
@@ -61,75 +73,84 @@ class SSSimulator:
             self.db.addDaemon(fakeDeamon, fakeDeamon)
         #self.logger.info('Daemons:', self.daemons)
     
-    # the main loop
+    # the main loop, a discrete-event simulation
+    # events are (time, kind, jobid), at the same time, jobs finish and come first, then scheduling
+    # only the next job of the trace has a submit event in the queue
     def run(self, alpha=0.9):
         done_cnt = 0
-        next_time = [x[2] for x in self.trace]
-        heapq.heapify(next_time)
-        while not self.isclean():
-            # new coming job at now
-            # trace is already sorted by submit time
-            while len(self.trace) and self.trace[0][2] <= self.clock.now():
-                fm = None
-                n = self.trace[0][0]
-                exe = n.split('-')[0]
-                if exe in ['gan', 'rnn']:
-                    fm = 'TensorFlow'
-                elif exe in ['ts', 'nw', 'wc']:
-                    fm = 'Spark'
-                else:
-                    fm = 'MPI'
-                jobid = self.db.addUserJob({'jobname': n, 'framework': fm, 'parallelism': self.trace[0][1], 'alpha': alpha})
-                self.pendingJobs[jobid] = self.trace[0]
-                self.trace.pop(0)
-                #print('put jid %d as pending' % jobid)
+        trace = iter(self.trace)
+        if self.stream is not None:
+            trace = itertools.chain(trace, self.stream)
+        self.trace = []
+        self.stream = None
+        events = []
+        incoming = next(trace, None)
+        if incoming:
+            heapq.heappush(events, (incoming[2], self.EVENT_SUBMIT, -1))
+        while len(events):
+            # skip to the next event
+            now = events[0][0]
+            self.clock.ticksto(now)
+            while len(events) and events[0][0] == now:
+                _, kind, jobid = heapq.heappop(events)
+                # a job finishes at now
+                if kind == self.EVENT_FINISH:
+                    for daemon in self.runningJobs.pop(jobid)[1]:
+                        self.db.daemonFinishJob(daemon, jobid, {'exitcode': 0})
+                    done_cnt += 1
+                    if done_cnt % 500 == 0:
+                        print('Simulation done for %d jobs' % done_cnt)
+                # new coming job at now, trace is already sorted by submit time
+                elif kind == self.EVENT_SUBMIT:
+                    fm = None
+                    n = incoming[0]
+                    exe = n.split('-')[0]
+                    if exe in ['gan', 'rnn']:
+                        fm = 'TensorFlow'
+                    elif exe in ['ts', 'nw', 'wc']:
+                        fm = 'Spark'
+                    else:
+                        fm = 'MPI'
+                    job = {'jobname': n, 'framework': fm, 'parallelism': incoming[1], 'alpha': alpha}
+                    # the duration of the trace is the walltime, so the estimation is the runtime used below
+                    if incoming[3] > 0:
+                        job['walltime'] = incoming[3]
+                    jobid = self.db.addUserJob(job)
+                    self.pendingJobs[jobid] = incoming
+                    incoming = next(trace, None)
+                    if incoming:
+                        heapq.heappush(events, (incoming[2], self.EVENT_SUBMIT, -1))
+                # EVENT_RETRY only asks for scheduling
 
             # if be able to start new job at now
             # try to schedule jobs, and get its estimated runtime
-
-            while True:
-                allocation, est = self.sched.nextJob()
+            for allocation, est in self.sched.scheduleRound():
                 self.logger.debug(allocation)
-                if allocation:
-                    if est is None:
-                        print(allocation)
-                    assert(est)
-                    daemons = []
-                    for daemon, jobspec in allocation:
-                        jobid = jobspec['jobid']
-                        daemons.append(daemon)
-                    # compute the duration and finish time
-                    jt = self.pendingJobs[jobid]
-                    # if no estimation time, use the standard duration
-                    est_time = est[0] if jt[3] == 0 else jt[3]*est[1]
-                    et = self.clock.now() + est_time
-                    # runningjob[id] = (finish time, daemons)
-                    self.runningJobs[jobid] = (et, list(daemons))
-                    heapq.heappush(next_time, et+1)
-                else:
-                    break
-
-            # if a job finish at now
-            flag = True
-            while flag:
-                flag = False
-                for jobid, v in self.runningJobs.items():
-                    # job finish
-                    if v[0] <= self.clock.now():
-                        for daemon in v[1]:
-                            self.db.daemonFinishJob(daemon, jobid, {'exitcode': 0})
-                        self.runningJobs.pop(jobid)
-                        done_cnt += 1
-                        if done_cnt % 500 == 0:
-                            print('Simulation done for %d jobs' % done_cnt)
-                            pass
-                        flag = True
-                        break
+                if est is None:
+                    print(allocation)
+                assert(est)
+                daemons = []
+                for daemon, jobspec in allocation:
+                    jobid = jobspec['jobid']
+                    daemons.append(daemon)
+                # compute the duration and finish time
+                jt = self.pendingJobs.pop(jobid)
+                # the estimation from the profile, or with a duration in the trace, jt[3]*est[1] (see SSDatabase.userEstimate)
+                est_time = est[0]
+                et = self.clock.now() + est_time
+                # runningjob[id] = (finish time, daemons)
+                self.runningJobs[jobid] = (et, list(daemons))
+                heapq.heappush(events, (et, self.EVENT_FINISH, jobid))
 
-            if len(next_time):
-                self.clock.ticksto(heapq.heappop(next_time))
-            else:
-                self.clock.tick()
+            # nothing will happen, but some jobs are pending, retry since the priorities change with time
+            # the stuck job is not retried before the capacity changes, so skip to the whole second
+            # when another job catches up with it
+            if len(events) == 0 and len(self.db.pendingJobs):
+                ts = self.db.nextPriorityChange()
+                if ts is None:
+                    self.logger.error('%d pending jobs can never be scheduled' % len(self.db.pendingJobs))
+                    break
+                heapq.heappush(events, (now + max(1, math.ceil(ts - now)), self.EVENT_RETRY, -1))
 
     def parse(self):
         self.parser.addRecords(self.parser.loadHistory(self.db.history))
@@ -138,6 +159,28 @@ class SSSimulator:
     def show(self):
         self.parser.showSchedFig(self.parser.selectRecords())
 
+# read a converted trace (see SSjobgenerator), a line of 'program,nproc,submittime,duration' each
+# at most limit jobs, the submit times are divided by submitDiv to make the trace denser
+# return the jobs sorted by submit time, the parsed trace is cached next to it (see SStrace)
+def readTrace(fname, limit=None, submitDiv=1):
+    return tuplesOf(loadTrace(fname, limit=limit, submitDiv=submitDiv))
+
+RESULT_HEADER = '%30s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s' % ('Algo', 'OCC(%)', 'MAX_TURN', 'USE_CH', 'BUB_CH', 'JOB_WAIT', 'JOB_RUN', 'JOB_TURN', 'CNTorITVL')
+
+# a line of the results under RESULT_HEADER, bs is from SSSimulator.parse
+def resultLine(sim, bs, cnt):
+    jobcnt = len(sim.parser.records)
+    return '%30s\t%8.2f\t%8.2f\t%8.0f\t%8.0f\t%8.0f\t%8.0f\t%8.0f\t%8.0f' % (
+        sim.sched.algo.name, 
+        bs['occupation'],
+        bs['max_turnaround'], 
+        bs['use_corehours'],
+        bs['bubble_corehours'],
+        sum(bs['jobwaittimes'])/jobcnt,
+        sum(bs['jobruntimes'])/jobcnt,
+        (sum(bs['jobwaittimes'])+sum(bs['jobruntimes']))/jobcnt,
+        cnt,)
+
 # For small generated traces
 '''
 if __name__ == '__main__':
@@ -198,24 +241,13 @@ if __name__ == '__main__':
     # convert_mustang_trace(light_rato=0.5)
     #SSjobgenerator.convert_trinity_trace(light_rato=0.25)
     #exit()
-    simCE = SSSimulator(alg='CE')
-    #simCS = SSSimulator(alg='CS')
-    simSS = SSSimulator(alg='SS')
-    trace = []
+    backfill = sys.argv[1].strip() if len(sys.argv) > 1 else 'none'
+    simCE = SSSimulator(alg='CE', backfill=backfill)
+    #simCS = SSSimulator(alg='CS', backfill=backfill)
+    simSS = SSSimulator(alg='SS', backfill=backfill)
     #with open('mustang_trace.txt', 'r') as fr:
     node_cnt = 9408
-    with open('trinity_trace.txt', 'r') as fr:
-        cnt = 0
-        for line in fr:
-            program, nproc, submittime, duration = line.strip().split(',')
-            #trace.append((program, min(int(nproc), node_cnt*28), float(submittime), float(duration)))
-            #trace.append((program, min(int(nproc), node_cnt//8*28), float(submittime), float(duration)))
-            trace.append((program, int(nproc), float(submittime)//4, float(duration)))
-            #trace.append((program, int(nproc), np.random.randint(0,1000), float(duration)))
-            cnt += 1
-            if cnt >= 10000:
-                break
-    trace.sort(key=lambda x: x[2])
+    trace = readTrace('trinity_trace.txt', limit=10000, submitDiv=4)
     # at most 1000 jobs
     #trace = trace[0:min([len(trace),500])]
     print('Going to simulate %d jobs' % len(trace))
@@ -229,25 +261,15 @@ if __name__ == '__main__':
         use_cs += cs
     print('used core hour: %.2f, total core hour: %.2f (et=%.2f), occupation = %.2f' % (use_cs/3600, max_et*node_cnt*28/3600, max_et, use_cs/(max_et*node_cnt*28)))
     #print('Job trace:', ', '.join(['%s(%d)' % (x[0], x[2]) for x in trace]))
-    header = '%30s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s' % ('Algo', 'OCC(%)', 'MAX_TURN', 'USE_CH', 'BUB_CH', 'JOB_WAIT', 'JOB_RUN', 'JOB_TURN', 'CNTorITVL')
-    print(header)
+    print(RESULT_HEADER)
     for sim in [simCE, simSS]:
         sim.addTrace(trace)
         sim.addFakeDeamons('sn', node_cnt)
         #sim.addFakeDeamons('bic0', 9408)
         sim.run(alpha=0.9) 
         bs = sim.parse()
-        jobcnt = len(sim.parser.records)
-        result = '%30s\t%8.2f\t%8.2f\t%8.0f\t%8.0f\t%8.0f\t%8.0f\t%8.0f\t%8.0f' % (
-            sim.sched.algo.name, 
-            bs['occupation'],
-            bs['max_turnaround'], 
-            bs['use_corehours'],
-            bs['bubble_corehours'],
-            sum(bs['jobwaittimes'])/jobcnt,
-            sum(bs['jobruntimes'])/jobcnt,
-            (sum(bs['jobwaittimes'])+sum(bs['jobruntimes']))/jobcnt,
-            node_cnt,)
-        print(result)
+        print(resultLine(sim, bs, node_cnt))
+        if backfill != 'none':
+            print('%30s\t%8d jobs backfilled' % ('', bs['backfilled_jobs']))
 '''
 '''
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+import os
+import sys
+import time
+import random
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+from SSsimulator import SSSimulator, resultLine, RESULT_HEADER
+from SStrace import loadTrace, iterArray
+
+'''
+SSsweep runs the simulator over all the (trace, node_cnt, alpha, algorithm, seed) points in parallel.
+The traces are loaded once as arrays (see SStrace), before the workers are forked, so every worker
+shares them instead of reading and parsing them again, and streams its jobs from them.
+Each point is one simulation in a worker, its result line is sent back, and the lines are written
+in the order of the points, as one table of RESULT_HEADER with the sweep parameters appended.
+The simulation itself is deterministic, the seed draws a uniform jitter of the submit times in
+[0, jitter) seconds, so with --jitter 0 (default) the seeds only repeat the same point.
+'''
+SWEEP_HEADER = '\t%8s\t%20s\t%6s\t%8s\t%8s' % ('ALPHA', 'TRACE', 'SEED', 'BACKFILL', 'BF_JOBS')
+
+# trace name -> trace, filled in the parent before the pool forks
+TRACES = dict()
+
+def jittered(trace, seed, jitter):
+    rng = np.random.default_rng(seed)
+    trace = trace.copy()
+    trace['submit'] += rng.uniform(0, jitter, size=len(trace))
+    return trace[np.argsort(trace['submit'], kind='stable')]
+
+# one point of the sweep, in a worker
+def runPoint(point):
+    tname, node_cnt, alpha, alg, seed, backfill, jitter = point
+    random.seed(seed)
+    np.random.seed(seed)
+    trace = TRACES[tname]
+    if jitter > 0:
+        trace = jittered(trace, seed, jitter)
+    # the simulator prints its progress, keep the table clean
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        st = time.time()
+        sim = SSSimulator(alg=alg, backfill=backfill)
+        sim.addStream(iterArray(trace))
+        sim.addFakeDeamons('sn', node_cnt)
+        sim.run(alpha=alpha)
+        bs = sim.parse()
+        elapsed = time.time() - st
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    line = resultLine(sim, bs, node_cnt) + '\t%8.2f\t%20s\t%6d\t%8s\t%8d' % (
+        alpha, os.path.basename(tname), seed, backfill, bs['backfilled_jobs'] if backfill != 'none' else 0)
+    return (line, elapsed)
+
+def parseArgs():
+    ap = argparse.ArgumentParser(description='Run the simulator over a grid of parameters in parallel.')
+    ap.add_argument('--trace', nargs='+', required=True, help='converted traces, a line of program,nproc,submittime,duration each')
+    ap.add_argument('--algs', nargs='+', default=['CE', 'SS'], help='scheduling algorithms (CE/CS/SS)')
+    ap.add_argument('--alphas', nargs='+', type=float, default=[0.9])
+    ap.add_argument('--nodes', nargs='+', type=int, default=[9408], help='cluster sizes')
+    ap.add_argument('--seeds', nargs='+', type=int, default=[0])
+    ap.add_argument('--jitter', type=float, default=0, help='seconds of random submit time jitter drawn with the seed')
+    ap.add_argument('--backfill', default='none', help='none/easy, the trace durations are the walltimes of easy backfilling')
+    ap.add_argument('--jobs', type=int, default=10000, help='at most this number of jobs from each trace')
+    ap.add_argument('--submit-div', type=int, default=4, help='submit times are divided by this')
+    ap.add_argument('--procs', type=int, default=os.cpu_count(), help='worker processes')
+    ap.add_argument('--out', default=None, help='also write the table to this file')
+    return ap.parse_args()
+
+if __name__ == '__main__':
+    args = parseArgs()
+    for tname in args.trace:
+        TRACES[tname] = loadTrace(tname, limit=args.jobs, submitDiv=args.submit_div)
+        print('Loaded %d jobs from %s' % (len(TRACES[tname]), tname), file=sys.stderr)
+    points = [(tname, node_cnt, alpha, alg, seed, args.backfill, args.jitter)
+        for tname, node_cnt, alpha, alg, seed in itertools.product(args.trace, args.nodes, args.alphas, args.algs, args.seeds)]
+    procs = max(1, min(args.procs, len(points)))
+    print('Going to run %d simulations with %d processes' % (len(points), procs), file=sys.stderr)
+
+    st = time.time()
+    lines = []
+    busy = 0
+    # fork so that the workers see TRACES without pickling it, one point per task for balance
+    with multiprocessing.get_context('fork').Pool(procs) as pool:
+        for i, (line, elapsed) in enumerate(pool.imap(runPoint, points, chunksize=1)):
+            lines.append(line)
+            busy += elapsed
+            print('[%d/%d] %s (%.1fs)' % (i+1, len(points), ' '.join(map(str, points[i][:5])), elapsed), file=sys.stderr)
+    print('Sweep done in %.1fs, %.1fs of simulations' % (time.time() - st, busy), file=sys.stderr)
+
+    table = '\n'.join([RESULT_HEADER + SWEEP_HEADER] + lines) + '\n'
+    sys.stdout.write(table)
+    if args.out:
+        with open(args.out, 'w') as fw:
+            fw.write(table)
@@ -0,0 +1,86 @@
+import os
+import heapq
+import numpy as np
+
+'''
+Job traces as NumPy structured arrays, a row (prog, nproc, submit, duration) per job, sorted by submit time,
+the prog field is as wide as the longest program name of the trace (see traceDtype).
+The converted text traces (see SSjobgenerator) have a line 'prog,nproc,submittime,duration' per job.
+A parsed trace is cached next to its source, e.g. trinity_trace.txt.n10000.d4.npy for the first 10000 jobs
+with the submit times divided by 4, and parsed again when the source is newer than the cache.
+The cache is memory mapped when it is streamed, so a trace of millions of jobs is not held in memory.
+'''
+def traceDtype(progWidth):
+    return np.dtype([('prog', 'S%d' % max(1, progWidth)), ('nproc', 'i8'), ('submit', 'f8'), ('duration', 'f8')])
+
+# the cache of fname for the parameters, params is a list of (letter, value) with value None for the default
+def cacheName(fname, params):
+    tags = ['%s%s' % (k, v) for k, v in params if v is not None]
+    return '.'.join([fname] + tags + ['npy'])
+
+# the array in the cache of fname, from parse() if the cache is missing or older than fname
+def cachedArray(fname, params, parse, mmap=False):
+    npyname = cacheName(fname, params)
+    if os.path.exists(npyname) and os.path.getmtime(npyname) >= os.path.getmtime(fname):
+        return np.load(npyname, mmap_mode='r' if mmap else None)
+    arr = parse()
+    # written aside and renamed, simulations in parallel may load the same trace
+    tmpname = '%s.%d.tmp' % (npyname, os.getpid())
+    with open(tmpname, 'wb') as fw:
+        np.save(fw, arr)
+    os.replace(tmpname, npyname)
+    return np.load(npyname, mmap_mode='r') if mmap else arr
+
+# the first limit jobs of a text trace, sorted by submit time (a stable sort, as list.sort)
+def parseTrace(fname, limit=None, submitDiv=1):
+    cols = np.loadtxt(fname, delimiter=',', dtype=str, max_rows=limit, ndmin=2, comments=None)
+    progs = np.char.encode(np.char.strip(cols[:, 0]), 'utf-8')
+    arr = np.zeros(len(cols), dtype=traceDtype(progs.itemsize))
+    arr['prog'] = progs
+    arr['nproc'] = cols[:, 1].astype(np.int64)
+    arr['submit'] = cols[:, 2].astype(float)
+    arr['duration'] = cols[:, 3].astype(float)
+    if submitDiv != 1:
+        arr['submit'] = arr['submit'] // submitDiv
+    return arr[np.argsort(arr['submit'], kind='stable')]
+
+def loadTrace(fname, limit=None, submitDiv=1, mmap=False):
+    params = [('n', limit), ('d', submitDiv if submitDiv != 1 else None)]
+    return cachedArray(fname, params, lambda: parseTrace(fname, limit, submitDiv), mmap=mmap)
+
+# the jobs of a trace array as (prog, nproc, submittime, duration), chunk rows at a time
+def iterArray(arr, chunk=65536):
+    for i in range(0, len(arr), chunk):
+        rows = arr[i:i+chunk]
+        progs = [p.decode() for p in rows['prog'].tolist()]
+        yield from zip(progs, rows['nproc'].tolist(), rows['submit'].tolist(), rows['duration'].tolist())
+
+def tuplesOf(arr):
+    return list(iterArray(arr))
+
+# replay a text trace with bounded memory, without parsing it all first
+# the lines only have to be sorted by submit time within window lines, as the raw traces nearly are,
+# a job that comes later than that is replayed late, at the submit time of the job before it
+def streamTrace(fname, window=100000, limit=None, submitDiv=1):
+    heap = []
+    last = None
+    def emit(job):
+        nonlocal last
+        if last is not None and job[2] < last:
+            job = (job[0], job[1], last, job[3])
+        last = job[2]
+        return job
+    with open(fname, 'r') as fr:
+        for i, line in enumerate(fr):
+            if limit and i >= limit:
+                break
+            program, nproc, submittime, duration = line.strip().split(',')
+            # i keeps the order of the file for the same submit time
+            submittime = float(submittime) if submitDiv == 1 else float(submittime)//submitDiv
+            heapq.heappush(heap, (submittime, i, program, int(nproc), float(duration)))
+            if len(heap) > window:
+                st, _, program, nproc, duration = heapq.heappop(heap)
+                yield emit((program, nproc, st, duration))
+    while len(heap):
+        st, _, program, nproc, duration = heapq.heappop(heap)
+        yield emit((program, nproc, st, duration))